@@ -9,6 +9,8 @@ class LocationForm(FlaskForm):
     group_id = StringField("Group id")
     type = SelectField("Type", choices=Location.TYPES, coerce=int)
     description = StringField("Description", validators=[DataRequired()])
+    is_enabled = BooleanField("Enabled")
+    enter_price = IntegerField("Enter price", default=0, validators=[NumberRange(min=0)])
 
     def __init__(self, *args, obj=None, **kwargs):
         if obj is not None:
@@ -33,6 +35,8 @@ class LocationForm(FlaskForm):
         obj.type = self.data["type"]
         obj.name = self.data["name"]
         obj.description = self.data["description"]
+        obj.is_enabled = self.data["is_enabled"]
+        obj.enter_price = self.data["enter_price"]
         if self.data["group_id"]:
             obj.group = LocationGroup.select().where(LocationGroup.id == int(self.data["group_id"]))
         else:
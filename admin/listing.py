@@ -0,0 +1,95 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+from urllib.parse import urlencode
+from game.models import Location, LocationGateway
+
+PAGE_SIZE = 50
+
+Node = namedtuple("Node", ["id", "name", "type", "group"])
+
+
+def _encode(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _decode(cursor):
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        return None
+    return values if isinstance(values, list) and len(values) == 2 else None
+
+
+# Keyset pagination: a page is "the next PAGE_SIZE rows after (sort value,
+# id)" instead of an OFFSET, so deep pages cost the same as the first one.
+# Sort columns must be non-null; id breaks ties. `after`/`before` carry the
+# cursor, every other argument (filters, sort, order) is kept in the links.
+class Page:
+    def __init__(self, query, model, sorts, args, size=PAGE_SIZE):
+        self.args = {key: value for key, value in args.items() if key not in ("after", "before") and value}
+        self.sort = args.get("sort") if args.get("sort") in sorts else "id"
+        self.descending = args.get("order") == "desc"
+        field, pk = sorts[self.sort], model._meta.primary_key
+        before = _decode(args.get("before"))
+        cursor = before or _decode(args.get("after"))
+        forward = before is None
+        ascending = forward != self.descending
+        if cursor:
+            value, id = cursor
+            if ascending:
+                query = query.where((field > value) | ((field == value) & (pk > id)))
+            else:
+                query = query.where((field < value) | ((field == value) & (pk < id)))
+        order = (field.asc(), pk.asc()) if ascending else (field.desc(), pk.desc())
+        rows = list(query.order_by(*order).limit(size + 1))
+        more = len(rows) > size
+        self.rows = rows[:size]
+        if not forward:
+            self.rows.reverse()
+
+        def key(row):
+            return [row._data[field.name], row._data[pk.name]]
+
+        self.next_url = self.prev_url = None
+        if self.rows and (more if forward else cursor):
+            self.next_url = self.url(after=_encode(key(self.rows[-1])))
+        if self.rows and (cursor if forward else more):
+            self.prev_url = self.url(before=_encode(key(self.rows[0])))
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def url(self, **changes):
+        args = dict(self.args, **changes)
+        return "?" + urlencode({key: value for key, value in args.items() if value})
+
+    def sort_url(self, sort):
+        # clicking the current sort column flips the order
+        order = "asc" if sort == self.sort and self.descending else "desc" if sort == self.sort else None
+        return self.url(sort=sort, order=order)
+
+
+def group_graph(group_id):
+    # every gateway touching the group with both ends, in one query;
+    # ends outside the group become border nodes
+    source, target = Location.alias(), Location.alias()
+    rows = (LocationGateway
+            .select(source.id, source.name, source.type, source.group,
+                    target.id, target.name, target.type, target.group)
+            .join(source, on=(LocationGateway.from_location == source.id))
+            .switch(LocationGateway)
+            .join(target, on=(LocationGateway.to_location == target.id))
+            .where((source.group == group_id) | (target.group == group_id))
+            .tuples())
+    edges, borders = set(), {}
+    for row in rows:
+        ends = Node(*row[:4]), Node(*row[4:])
+        for end in ends:
+            if end.group != group_id:
+                borders[end.id] = end
+        edges.add(tuple(sorted((ends[0].id, ends[1].id))))
+    return edges, list(borders.values())
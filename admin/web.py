@@ -1,17 +1,25 @@
 import os
 import datetime
+import glob
+import json
 from game.models import *
+from game.world import world
+from game import conditions
 from .forms import *
+from .listing import Page, group_graph
+from runtime.metrics import merge as merge_metrics
 from flask import Flask, g, request, session, redirect, Response
 from flask.json import jsonify
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 
 _jinja_env = Environment(
     loader=FileSystemLoader(os.path.join(
         os.path.dirname(os.path.realpath(__file__)),
         "templates"
-    ))
+    )),
+    # filter forms echo query arguments back into the page
+    autoescape=select_autoescape(["html"])
 )
 
 
@@ -24,16 +32,52 @@ app.config["SECRET_KEY"] = settings.SECRET_KEY
 app.config["WTF_CSRF_ENABLED"] = False
 
 
+@app.teardown_request
+def release_db(exc):
+    # connections are pooled per thread; give this one back
+    if not settings.DB.is_closed():
+        settings.DB.close()
+
+
 @app.route("/")
 def index():
     return render("index.html")
 
 
+@app.route("/metrics")
+def metrics():
+    # written by the bot, see runtime/metrics.py; webhook shards write
+    # METRICS_FILE.<shard> and are merged here, labelled by shard
+    if not settings.METRICS_FILE:
+        return Response("", status=404)
+    files = []
+    for path in [settings.METRICS_FILE] + sorted(glob.glob(f"{settings.METRICS_FILE}.[0-9]*")):
+        if not os.path.exists(path) or path.endswith(".tmp"):
+            continue
+        suffix = path[len(settings.METRICS_FILE):].lstrip(".")
+        with open(path) as f:
+            files.append(({"shard": suffix} if suffix else None, f.read()))
+    if not files:
+        return Response("", status=404)
+    return Response(merge_metrics(files), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/locations/")
 def locations_index():
-    locations = Location.select()
+    locations = (Location
+                 .select(Location, LocationGroup)
+                 .join(LocationGroup, JOIN.LEFT_OUTER))
+    if request.args.get("name"):
+        locations = locations.where(Location.name.startswith(request.args["name"]))
+    if request.args.get("type", "").isdigit():
+        locations = locations.where(Location.type == int(request.args["type"]))
+    if request.args.get("group", "").isdigit():
+        locations = locations.where(Location.group == int(request.args["group"]))
     return render("locations/index.html", {
-        "locations": locations
+        "locations": Page(locations, Location, {"id": Location.id, "name": Location.name,
+                                                "type": Location.type}, request.args),
+        "types": Location.TYPES,
+        "args": request.args
     })
 
 
@@ -51,9 +95,12 @@ def locations_create():
                 location.group = group
             location.save()
             if adj_id:
-                adj_location = Location.select().where(Location.id == int(adj_id))
-                LocationGateway.create(from_location=adj_location, to_location=location, condition={})
-                LocationGateway.create(from_location=location, to_location=adj_location, condition={})
+                adj_id = int(adj_id)
+                LocationGateway.insert_many([
+                    {"from_location": adj_id, "to_location": location.id, "condition": {}},
+                    {"from_location": location.id, "to_location": adj_id, "condition": {}},
+                ]).execute()
+        world.invalidate()
         return redirect(f"/locations/{location.id}")
     return render("locations/create.html", {
         "form": form,
@@ -76,6 +123,7 @@ def locations_edit(lid):
     if request.method == "POST" and form.validate_on_submit():
         form.populate_obj(location)
         location.save()
+        world.invalidate()
         return redirect(f"/locations/{location.id}")
     return render("locations/edit.html", {
         "form": form
@@ -96,29 +144,18 @@ def groups_create():
 @app.route("/groups/")
 def groups_index():
     groups = LocationGroup.select()
+    if request.args.get("type", "").isdigit():
+        groups = groups.where(LocationGroup.type == int(request.args["type"]))
     return render("groups/index.html", {
-        "groups": groups,
-        "form": form,
+        "groups": Page(groups, LocationGroup, {"id": LocationGroup.id, "name": LocationGroup.name},
+                       request.args),
     })
 
 @app.route("/groups/<int:gid>", methods=["GET", "POST"])
 def groups_detail(gid):
     group = LocationGroup.select().where(LocationGroup.id == gid).get()
-    locations = Location.select().where(Location.group == group)
-    edges = set()
-    borders = set()
-
-    def add_edge(edge, end):
-        if edge:
-            if end.group != group:
-                borders.add(end)
-            edges.add(tuple(sorted((edge.from_location.id, edge.to_location.id))))
-
-    for loc in locations:
-        for edge in LocationGateway.select().where(LocationGateway.from_location == loc):
-            add_edge(edge, edge.to_location)
-        for edge in LocationGateway.select().where(LocationGateway.to_location == loc):
-            add_edge(edge, edge.from_location)
+    locations = Location.select(Location.id, Location.name, Location.type).where(Location.group == group)
+    edges, borders = group_graph(group.id)
 
     return render("groups/detail.html", {
         "group": group,
@@ -134,8 +171,11 @@ def gateways_create():
     from_location = Location.select().where(Location.id == fr).first()
     to_location = Location.select().where(Location.id == to).first()
     if from_location and to_location:
-        LocationGateway.create(from_location=from_location, to_location=to_location, condition={})
-        LocationGateway.create(from_location=to_location, to_location=from_location, condition={})
+        LocationGateway.insert_many([
+            {"from_location": from_location.id, "to_location": to_location.id, "condition": {}},
+            {"from_location": to_location.id, "to_location": from_location.id, "condition": {}},
+        ]).execute()
+        world.invalidate()
     return jsonify({})
 
 
@@ -152,13 +192,47 @@ def gateways_delete():
         LocationGateway.delete().where(
             (LocationGateway.from_location == to_location) & (LocationGateway.to_location == from_location)
         ).execute()
+        world.invalidate()
     return jsonify({})
 
 
+@app.route("/gateways/condition", methods=["POST"])
+def gateways_condition():
+    fr = int(request.form.get("from"))
+    to = int(request.form.get("to"))
+    try:
+        condition = json.loads(request.form.get("condition") or "{}")
+        conditions.validate(condition)
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+    LocationGateway.update(condition=condition).where(
+        (LocationGateway.from_location == fr) & (LocationGateway.to_location == to)
+    ).execute()
+    world.invalidate()
+    return jsonify({"msg": "ok"})
+
+
 @app.route("/heroes/")
 def heroes_index():
+    heroes = (Hero
+              .select(Hero, HeroState, Location, Activity)
+              .join(HeroState)
+              .switch(Hero)
+              .join(Location)
+              .switch(Hero)
+              .join(Activity, JOIN.LEFT_OUTER))
+    if request.args.get("name"):
+        heroes = heroes.where(Hero.name.startswith(request.args["name"]))
+    if request.args.get("state", "").isdigit():
+        heroes = heroes.where(Hero.state == int(request.args["state"]))
+    if request.args.get("location", "").isdigit():
+        heroes = heroes.where(Hero.location == int(request.args["location"]))
     return render("heroes/index.html", {
-        "heroes": Hero.select()
+        "heroes": Page(heroes, Hero, {"id": Hero.id, "name": Hero.name, "gold": Hero.gold,
+                                      "xp": Hero.xp_value}, request.args),
+        "states": HeroState.select().order_by(HeroState.id),
+        "types_dict": dict(Activity.TYPES),
+        "args": request.args
     })
 
 
@@ -202,14 +276,12 @@ def heroes_edit(hid):
 def heroes_new_activity(hid):
     hero = Hero.select().where(Hero.id == hid).get()
     form = ActivityForm()
-    activity = Activity()
     if request.method == "POST" and form.validate_on_submit():
-        form.populate_obj(activity)
         with settings.DB.atomic():
             if hero.activity:
                 hero.activity.delete()
-            activity.save()
-            hero.activity = activity
+            # begin() sets due_time, which the scheduler and the sweep go by
+            hero.activity = Activity.begin(form.data["type"], form.data["duration"])
             hero.save()
         return redirect(f"/heroes/{hero.id}")
     return render("heroes/new-activity.html", {
@@ -230,6 +302,7 @@ def items_default(iid):
     if request.method == "POST" and form.validate_on_submit():
         form.populate_obj(item)
         item.save()
+        world.invalidate()
         return redirect(f"/items/{item.id}")
     return render("heroes/change-item.html", {
         "form": form
@@ -0,0 +1,90 @@
+import queue
+import time
+
+
+class Timeout(Exception):
+    pass
+
+
+def buttons(markup):
+    if not markup:
+        return []
+    return [button if isinstance(button, str) else button.get("text")
+            for row in markup.get("keyboard", []) for button in row]
+
+
+def offers(*labels):
+    return lambda text, markup: any(label in buttons(markup) for label in labels)
+
+
+def says(*fragments):
+    return lambda text, markup: any(fragment in text for fragment in fragments)
+
+
+def either(*predicates):
+    return lambda text, markup: any(predicate(text, markup) for predicate in predicates)
+
+
+# A synthetic player talking to the bot through the fake Bot API. Every
+# message it sends is timed until the bot's first answer to that chat;
+# `until` keeps reading the chat until a matching message arrives.
+class Player:
+    def __init__(self, fake, chat_id, name, stats, timeout=10):
+        self.fake = fake
+        self.chat_id = chat_id
+        self.name = name
+        self.stats = stats
+        self.timeout = timeout
+        self.inbox = queue.Queue()
+
+    def deliver(self, text, markup):
+        self.inbox.put((time.monotonic(), text, markup))
+
+    def say(self, text, until=None, step=None):
+        sent = time.monotonic()
+        self.fake.push_message(self.chat_id, text)
+        answered = False
+        deadline = sent + self.timeout
+        while True:
+            try:
+                received, reply, markup = self.inbox.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.stats.timeout(step or text)
+                raise Timeout(f"{self.name}: no answer to {text!r}")
+            if received < sent:
+                continue
+            if not answered:
+                self.stats.latency(step or text, received - sent)
+                answered = True
+            if until is None or until(reply, markup):
+                return reply, markup
+
+
+def adventure(player, fight_rounds=20):
+    # register -> travel -> fight -> shop -> heal
+    player.say(f"/register {player.name}", until=offers("Travel"), step="register")
+
+    player.say("/goto Goblin's Cave", until=offers("Attack"), step="travel")
+    for _ in range(fight_rounds):
+        text, _ = player.say("Attack", until=says("HP:", "You killed", "You were killed", "Can't"),
+                             step="fight")
+        if "You were killed" in text:
+            return "died"
+        if "You killed" in text or "Can't" in text:
+            break
+    else:
+        player.say("Run away", step="fight")
+
+    text, _ = player.say("/goto Market", until=either(offers("Shop"), says("can't travel")), step="travel")
+    if "can't travel" in text:
+        # the next encounter came first
+        player.say("Run away", until=offers("Leave"), step="fight")
+        player.say("/goto Market", until=offers("Shop"), step="travel")
+    player.say("Shop", until=offers("Leave"), step="shop")
+    player.say("Buy 'Plain Shield'", until=offers("Leave"), step="shop")
+    player.say("Sell 'Plain Shield'", until=offers("Leave"), step="shop")
+    player.say("Leave", until=offers("Shop"), step="shop")
+
+    player.say("/goto Tavern", until=offers("Heal"), step="travel")
+    player.say("Heal", until=says("recovering"), step="heal")
+    return "done"
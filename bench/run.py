@@ -0,0 +1,222 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from runtime.fake_telegram import FakeTelegram
+from bench.players import Player, Timeout, adventure
+
+logger = logging.getLogger("bench")
+
+# Load test: the bot runs in this process against runtime/fake_telegram.py
+# and a crowd of players plays bench/players.py:adventure. Needs the
+# Postgres from conf.py, created with `0pg createdb`:
+#
+#   python -m bench.run --players 1000 --output bench.json
+#   python -m bench.run --players 1000 --baseline bench.json  # exits 1 on regressions
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.timeouts = collections.Counter()
+        self.outcomes = collections.Counter()
+        self.update_queries = []
+        self.update_times = []
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def latency(self, step, seconds):
+        with self._lock:
+            self.latencies[step].append(seconds)
+
+    def timeout(self, step):
+        with self._lock:
+            self.timeouts[step] += 1
+
+    def outcome(self, name):
+        with self._lock:
+            self.outcomes[name] += 1
+
+    def summary(self, elapsed):
+        everything = [value for values in self.latencies.values() for value in values]
+        steps = {}
+        for step, values in sorted(self.latencies.items()):
+            steps[step] = {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+            }
+        return {
+            "elapsed": elapsed,
+            "updates": len(self.update_times),
+            "throughput": len(self.update_times) / elapsed if elapsed else 0.0,
+            "p50": percentile(everything, 50),
+            "p95": percentile(everything, 95),
+            "p99": percentile(everything, 99),
+            "handler_p95": percentile(self.update_times, 95),
+            "queries": self.queries,
+            "queries_per_update": (sum(self.update_queries) / len(self.update_queries)
+                                   if self.update_queries else 0.0),
+            "queries_per_update_p95": percentile(self.update_queries, 95),
+            "steps": steps,
+            "timeouts": dict(self.timeouts),
+            "outcomes": dict(self.outcomes),
+        }
+
+
+def instrument(db, dispatcher, stats):
+    # Count every statement, and attribute the ones issued while a handler
+    # runs to that update (handlers run one per thread).
+    current = threading.local()
+    execute_sql = db.execute_sql
+    process_update = dispatcher.process_update
+    lock = threading.Lock()
+
+    def counted_execute_sql(*args, **kwargs):
+        with lock:
+            stats.queries += 1
+        if getattr(current, "queries", None) is not None:
+            current.queries += 1
+        return execute_sql(*args, **kwargs)
+
+    def timed_process_update(update):
+        current.queries = 0
+        started = time.monotonic()
+        try:
+            return process_update(update)
+        finally:
+            stats.update_times.append(time.monotonic() - started)
+            stats.update_queries.append(current.queries)
+            current.queries = None
+
+    db.execute_sql = counted_execute_sql
+    dispatcher.process_update = timed_process_update
+
+
+def format_summary(summary):
+    lines = [
+        f"updates       {summary['updates']} in {summary['elapsed']:.1f}s "
+        f"({summary['throughput']:.1f}/s)",
+        f"latency       p50 {summary['p50'] * 1000:.1f}ms  p95 {summary['p95'] * 1000:.1f}ms  "
+        f"p99 {summary['p99'] * 1000:.1f}ms",
+        f"handler       p95 {summary['handler_p95'] * 1000:.1f}ms",
+        f"queries       {summary['queries']} total, {summary['queries_per_update']:.2f} per update "
+        f"(p95 {summary['queries_per_update_p95']})",
+        "",
+        f"{'step':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}",
+    ]
+    for step, row in summary["steps"].items():
+        lines.append(f"{step:<12}{row['count']:>8}{row['p50'] * 1000:>10.1f}"
+                     f"{row['p95'] * 1000:>10.1f}{row['p99'] * 1000:>10.1f}")
+    if summary["timeouts"]:
+        lines.append("")
+        lines.append("timeouts      " + ", ".join(f"{step}: {count}" for step, count in summary["timeouts"].items()))
+    lines.append("outcomes      " + ", ".join(f"{name}: {count}" for name, count in summary["outcomes"].items()))
+    return "\n".join(lines)
+
+
+def regressions(summary, baseline, tolerance):
+    # worse than the baseline by more than `tolerance` (a fraction)
+    found = []
+    for key in ("p50", "p95", "p99", "queries_per_update"):
+        if baseline.get(key) and summary[key] > baseline[key] * (1 + tolerance):
+            found.append(f"{key}: {summary[key]:.4f} > {baseline[key]:.4f}")
+    if baseline.get("throughput") and summary["throughput"] < baseline["throughput"] * (1 - tolerance):
+        found.append(f"throughput: {summary['throughput']:.1f} < {baseline['throughput']:.1f}")
+    if sum(summary["timeouts"].values()) > sum(baseline.get("timeouts", {}).values()):
+        found.append("more timeouts than the baseline")
+    return found
+
+
+def start_bot(fake):
+    # conf reads the environment on import, so the bot is imported only
+    # once it is pointed at the fake API
+    os.environ["TELEGRAM_API_URL"] = fake.url
+    os.environ.setdefault("API_TOKEN", "bench")
+    # the outbound limits protect the real Telegram, not the fake one
+    os.environ.setdefault("SEND_GLOBAL_RATE", "100000")
+    os.environ.setdefault("SEND_CHAT_RATE", "1000")
+    os.environ.setdefault("SEND_CHAT_BURST", "100")
+    import bot
+    return bot
+
+
+def run_players(fake, stats, players, ramp, timeout, fight_rounds):
+    base = int(time.time()) * 100000
+    crowd = {}
+    fake.listeners.append(lambda chat_id, text, markup: chat_id in crowd and crowd[chat_id].deliver(text, markup))
+
+    def play(player):
+        try:
+            stats.outcome(adventure(player, fight_rounds))
+        except Timeout as e:
+            logger.warning("%s", e)
+            stats.outcome("timeout")
+        except Exception:
+            logger.exception("%s failed", player.name)
+            stats.outcome("error")
+
+    threading.stack_size(256 * 1024)
+    threads = []
+    for n in range(players):
+        chat_id = base + n
+        player = crowd[chat_id] = Player(fake, chat_id, f"bench{chat_id}", stats, timeout)
+        thread = threading.Thread(target=play, args=(player,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        if ramp:
+            time.sleep(ramp / players)
+    for thread in threads:
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive synthetic players through the bot and report latency")
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--ramp", type=float, default=10.0, help="seconds over which players join")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for an answer")
+    parser.add_argument("--fight-rounds", type=int, default=20)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--output", help="write the summary as JSON")
+    parser.add_argument("--baseline", help="JSON summary of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    fake = FakeTelegram(port=args.port).start()
+    bot = start_bot(fake)
+    updater = bot.build_updater()
+    stats = Stats()
+    instrument(bot.settings.DB, updater.dispatcher, stats)
+    threading.Thread(target=bot.serve, args=(updater, "async"), daemon=True).start()
+
+    started = time.monotonic()
+    run_players(fake, stats, args.players, args.ramp, args.timeout, args.fight_rounds)
+    summary = stats.summary(time.monotonic() - started)
+    print(format_summary(summary))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(summary, json.load(f), args.tolerance)
+        if found:
+            print("\nregressions:\n  " + "\n  ".join(found))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
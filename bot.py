@@ -1,15 +1,31 @@
 from envparse import env
 from conf import settings
-from enum import Enum, auto
 from functools import wraps
-from telegram import ReplyKeyboardMarkup
-from telegram.ext import Updater, ConversationHandler, CommandHandler, MessageHandler, Filters
-from game.models import Hero, HeroState, HeroStateTransition, Location, LocationGateway
-from game.models import Mob, MobInstance, ItemInstance, Activity, ShopSlot, Item, MobDwells, MobDrops
-from peewee import IntegrityError, fn
+from telegram import Bot, Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from game.models import Hero, Location, Activity, Action
+from game.world import world
+from game.routes import passable
+from game import conditions
+from game import combat
+from game.states import states
+from game.fsm import StateMachine, IllegalTransition, enter
+from game.heroes import load_hero, expired_heroes, move
+from game.fights import FightStore
+from game import shop
+from game import inventory
+from game.scheduler import Scheduler, pending_activities, last_activity, of_shard
+from game.activities import finish_healing, finish_respawn, resolve_expired
+from runtime.aio import AsyncRuntime
+from runtime.sender import OutboundQueue
+from runtime.outbox import ActionDelivery
+from runtime.metrics import Reporter, instrument_db, instrument_dispatcher, timed
+from runtime.webhook import WebhookServer, consume
+from runtime.keyboards import keyboards, inventories, markup
+from peewee import IntegrityError
 import logging
-import random
 import datetime
+import sys
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -18,14 +34,38 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 env.read_envfile()
 
+scheduler = Scheduler()
+fights = FightStore(settings.COMBAT_CHECKPOINT_ROUNDS)
+outbound = OutboundQueue(
+    global_rate=settings.SEND_GLOBAL_RATE,
+    chat_rate=settings.SEND_CHAT_RATE,
+    chat_burst=settings.SEND_CHAT_BURST,
+    workers=settings.SEND_WORKERS
+)
+# events that don't answer a message (timers) are written to the action
+# table with the state change and delivered from there
+delivery = ActionDelivery(
+    outbound,
+    workers=settings.OUTBOX_WORKERS,
+    batch_size=settings.OUTBOX_BATCH,
+    interval=settings.OUTBOX_INTERVAL,
+    lease=settings.OUTBOX_LEASE
+)
+
+machine = StateMachine(wrap=timed("zpg_state_handler_seconds", "Latency of the handlers of hero states"))
+lookup_hero = timed("zpg_hero_lookup_seconds", "Hero lookup of registered handlers")(load_hero)
+
+def reply(update, text, reply_markup=None):
+    outbound.send(update.effective_chat.id, text, reply_markup=reply_markup)
+
 def registered(func):
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
         try:
-            hero = Hero.get(chat_id=update.effective_chat.id)
+            hero = lookup_hero(chat_id=update.effective_chat.id)
         except Hero.DoesNotExist:
-            update.message.reply_text('You are not registered yet.\n'+
-                                        'Register with /register %nickname% command')
+            reply(update, 'You are not registered yet.\n'+
+                          'Register with /register %nickname% command')
             return
         else:
             return func(bot, update, hero, *args, **kwargs)
@@ -35,22 +75,22 @@ def start(bot, update):
     try:
         hero = Hero.get(chat_id=update.effective_chat.id)
     except Hero.DoesNotExist:
-        update.message.reply_text('You are not registered yet.\n'+
-                                    'Register with /register %nickname% command')
+        reply(update, 'You are not registered yet.\n'+
+                      'Register with /register %nickname% command')
     else:
-        update.message.reply_text(f'Name: {hero.name}\nHP:{hero.hp_value}')
+        reply(update, f'Name: {hero.name}\nHP:{hero.hp_value}')
 
-def register(bot, update, args, job_queue):
+def register(bot, update, args):
     nickname = args[0]
     try:
         hero = Hero.create(name=nickname, hp_base=100,
-                    location=Location.get(type=Location.START),
+                    location=world.start_locations()[0],
                     chat_id=update.effective_chat.id,
-                    state=HeroState.get(name='IDLE'))
+                    state=states.IDLE)
     except IntegrityError:
-        update.message.reply_text(f'Nickname {nickname} already exists')
+        reply(update, f'Nickname {nickname} already exists')
     else:
-        update.message.reply_text(f'Welcome, {nickname}')
+        reply(update, f'Welcome, {nickname}')
         actions(bot, update, hero)
 
 available_actions = {
@@ -60,320 +100,461 @@ available_actions = {
     Location.HEALING: ["Heal", "Travel"]
 }
 
+FIGHT_MARKUP = markup([["Attack", "Guard", "Run away"]], one_time=False)
+
+# Keyboards are cached as JSON (runtime/keyboards.py), keyed by everything
+# they show: rendering one costs no query unless an input changed.
+def actions_markup(hero):
+    location_type = hero.location.type
+    return keyboards.get(("actions", location_type),
+                         lambda: markup([available_actions[location_type]]))
+
 def actions(bot, update, hero):
-    replies = ReplyKeyboardMarkup([available_actions[hero.location.type]],
-                                    one_time_keyboard=True,
-                                    resize_keyboard=True)
-    bot.send_message(
-        text="What's your path?",
-        chat_id=hero.chat_id,
-        reply_markup=replies
-    )
+    outbound.send(hero.chat_id, "What's your path?", reply_markup=actions_markup(hero))
 
-def handle_actions(bot, update, hero, job_queue):
+def offered(bot, update, hero):
+    # IDLE buttons depend on the location as well
     query = update.message.text
-    if query not in available_actions[hero.location.type]:
-        update.message.reply_text(f"You can't do {query} from here")
-        return actions(bot, update, hero)
-    if query == 'Travel' or query == 'Leave':
-        return travel(bot, update, hero, job_queue)
-    elif query == 'Shop':
-        hero.state = HeroState.get(name='SHOPPING')
+    if query in available_actions[hero.location.type]:
+        return True
+    unavailable(bot, update, hero, query)
+    return False
+
+@machine.on('IDLE', 'Travel', 'Leave')
+def start_travel(bot, update, hero, rest):
+    if offered(bot, update, hero):
+        return travel(bot, update, hero)
+
+@machine.on('IDLE', 'Shop')
+def start_shopping(bot, update, hero, rest):
+    if offered(bot, update, hero):
+        enter(hero, states.SHOPPING)
         hero.save()
         return shop_actions(bot, update, hero)
-    elif query == 'Heal':
-        hero.state = HeroState.get(name="HEALING")
-        hero.activity = Activity.create(type=Activity.HEALING, duration=hero.get_full_recover_time())
-        hero.save()
-        update.message.reply_text(f"Your hero is recovering now... Return back in {int(hero.activity.duration)} seconds")
-        job_queue.run_once(do_heal, hero.activity.duration, context=hero.id)
 
+@machine.on('IDLE', 'Heal')
+def start_healing(bot, update, hero, rest):
+    if offered(bot, update, hero):
+        enter(hero, states.HEALING)
+        with settings.DB.atomic():
+            hero.activity = Activity.begin(Activity.HEALING, hero.get_full_recover_time())
+            hero.save()
+        reply(update, f"Your hero is recovering now... Return back in {int(hero.activity.duration)} seconds")
+        if not settings.LAZY_ACTIVITIES:
+            scheduler.schedule("heal", hero.activity.due_time, hero.id)
+
+@machine.on('IDLE')
+def unavailable(bot, update, hero, query):
+    reply(update, f"You can't do {query} from here")
+    return actions(bot, update, hero)
 
-def do_heal(bot, job):
-    hero = Hero.get(id=job.context)
-    hero.activity = None
-    hero.hp_value = hero.hp_base
-    hero.state = HeroState.get(name="IDLE")
-    hero.save()
-    bot.send_message(chat_id=hero.chat_id, text=f"Your hero recovered!")
-    return actions(bot, None, hero)
-
-
-def travel(bot, update, hero, job_queue):
-    paths = hero.location.exits
-    actions = ReplyKeyboardMarkup([[path.to_location.name for path in paths]],
-                                    one_time_keyboard=True,
-                                    resize_keyboard=True)
-    update.message.reply_text("Where do you want to go?",
-                                reply_markup=actions)
-    hero.state = HeroState.get(name='TRAVEL')
-    hero.save()
 
-def handle_travel(bot, update, hero, job_queue):
-    destination = update.message.text
+def do_heal(bot, hero_id):
+    with settings.DB.atomic():
+        hero = load_hero(hero_id=hero_id)
+        if finish_healing(hero):
+            notify_finished(hero, Activity.HEALING)
+    delivery.wake()
 
+
+def notify_finished(hero, activity_type):
+    if activity_type == Activity.HEALING:
+        Action.notify(hero, f"Your hero recovered!")
+    else:
+        Action.notify(hero, f"You respawned in {hero.location.name}!")
+    Action.notify(hero, "What's your path?", markup=actions_markup(hero))
+
+
+def travel(bot, update, hero):
+    snapshot = world.snapshot
+    paths = snapshot.exits.get(hero.location_id, [])
+    blocked = conditions.blocked(paths, hero)
+    actions = keyboards.get(
+        ("travel", snapshot.version, hero.location_id, blocked),
+        lambda: markup([[path.to_location.name for path in paths if passable(path, blocked)]])
+    )
+    enter(hero, states.TRAVEL)
+    reply(update, "Where do you want to go?", reply_markup=actions)
+    hero.save()
+
+@machine.on('TRAVEL')
+def handle_travel(bot, update, hero, destination):
     new_location = None
-    for dest in hero.location.exits:
+    for dest in world.open_exits(hero.location_id, hero):
         if dest.to_location.name == destination:
             new_location = dest.to_location
             break
 
     if new_location is None:
-        update.message.reply_text(f"You can't travel to {destination} from here")
-        return travel(bot, update, hero, job_queue)
+        reply(update, f"You can't travel to {destination} from here")
+        return travel(bot, update, hero)
 
-    hero.location = new_location
-    hero.state = HeroState.get(name='IDLE')
-    hero.save()
-    if hero.location.type == Location.FIGHT:
-        job_queue.run_once(fight, 0.1, context=hero.id)
+    return arrive(bot, update, hero, new_location, new_location.enter_price)
+
+@registered
+def goto(bot, update, hero, args):
+    if hero.activity or states.name_of(hero.state_id) not in ('IDLE', 'TRAVEL'):
+        reply(update, "You can't travel now")
+        return
+    destination = world.location_by_name(" ".join(args))
+    route = destination and world.route(hero.location_id, destination.id, hero)
+    if not route:
+        reply(update, f"There's no way to {' '.join(args)} from here")
+        return
+    cost, path = route
+    if not path:
+        reply(update, f"You are already in {destination.name}")
+        return
+    return arrive(bot, update, hero, destination, cost)
+
+def arrive(bot, update, hero, location, cost):
+    if not move(hero, location, cost):
+        if hero.gold < cost:
+            reply(update, f"You need {cost} gold to get to {location.name}")
+        else:
+            # attacked or moved since the hero was loaded; that news is on its way
+            reply(update, f"You can't get to {location.name} right now")
+            return
+        if states.name_of(hero.state_id) == 'TRAVEL':
+            return travel(bot, update, hero)
+        return actions(bot, update, hero)
+    if cost:
+        reply(update, f"You paid {cost} gold and arrived in {location.name}")
+    if location.type == Location.FIGHT:
+        scheduler.schedule_in("fight", 0.1, hero.id)
     return actions(bot, update, hero)
 
-def revive(bot, job):
-    hero = Hero.get(id=job.context)
-    hero.hp_value = hero.hp_base
-    activity = hero.activity
-    hero.activity = None
-    hero.state = HeroState.get(name="IDLE")
-    hero.location = Location.select().where(Location.type == Location.START).order_by(fn.Random()).limit(1).get()
-    hero.save()
-    activity.delete_instance()
-    bot.send_message(chat_id=hero.chat_id, text=f"You respawned in {hero.location.name}!")
-    return actions(bot, None, hero)
+def revive(bot, hero_id):
+    with settings.DB.atomic():
+        hero = load_hero(hero_id=hero_id)
+        if finish_respawn(hero):
+            notify_finished(hero, Activity.RESPAWN)
+    delivery.wake()
 
-def fight(bot, job):
-    hero = Hero.get(id=job.context)
-    if hero.location.type != Location.FIGHT or hero.state.name =='FIGHT':
-        return
-    rand = random.random()
-    start = 0
-    dwells = list(MobDwells.select().where(MobDwells.location == hero.location))
-    start = 0
-    mob_type = None
-    for dwell in dwells:
-        end = start + dwell.chance
-        if start <= rand < end:
-            mob_type = dwell.mob
-            break
-        start = end
-    assert mob_type
-    mob = MobInstance.create(type=mob_type, hp_value=mob_type.hp_base)
-    hero.state = HeroState.get(name='FIGHT')
-    hero.attacked_by = mob
-    hero.save()
-    bot.send_message(chat_id=hero.chat_id,
-                        text=f"You have encountered {mob.type.name}",
-                        reply_markup=ReplyKeyboardMarkup([["Attack", "Guard", "Run away"]],
-                        resize_keyboard=True))
-
-def on_kill(bot, update, hero, mob, job_queue):
-    update.message.reply_text(f"You killed {mob.type.name}")
-    hero.state = HeroState.get(name='IDLE')
-    hero.attacked_by = None
+def sweep(bot, _):
+    # lazy mode: heroes are restored on their next message, this only tells
+    # the ones who are waiting for it
+    try:
+        for hero in expired_heroes(settings.ACTIVITY_SWEEP_BATCH):
+            with settings.DB.atomic():
+                finished = resolve_expired(hero)
+                if finished is not None:
+                    notify_finished(hero, finished)
+        delivery.wake()
+    finally:
+        scheduler.schedule_in("sweep", settings.ACTIVITY_SWEEP_INTERVAL, None)
+
+def poll_activities(bot, key):
+    # eager mode: activities started outside the bot (the admin) have no
+    # timer here; pick up everything created since the last poll. Ours are
+    # picked up too, an extra timer finds them finished and does nothing.
+    after, shard, shards = key
+    watermark = after
+    try:
+        watermark = last_activity()
+        scheduler.schedule_many([(due, ACTIVITY_TIMERS[type], hero_id)
+                                 for hero_id, type, due in pending_activities(shard, shards, after=after)])
+    finally:
+        scheduler.schedule_in("poll", settings.ACTIVITY_POLL_INTERVAL, (watermark, shard, shards))
+
+def fight(bot, hero_id):
+    with settings.DB.atomic():
+        hero = load_hero(hero_id=hero_id)
+        started = start_encounter(hero)
+    if started:
+        delivery.wake()
+
+def start_encounter(hero):
+    location = hero.location
+    # heroes busy choosing a destination or shopping aren't attacked
+    if location.type != Location.FIGHT or hero.state_id != states.IDLE.id:
+        return False
+    spawns = world.spawn_table(location.id)
+    if spawns is None:
+        logger.warning("nobody dwells in %s", location.name)
+        return False
+    mob_type = spawns.sample()
+    enter(hero, states.FIGHT)
+    fights.start(hero, mob_type)
     hero.save()
-    mob.delete_instance()
-    dropped = []
-    for drop in mob.type.drops:
-        if random.random() < drop.chance:
-            item_instance = ItemInstance.create(
-                type=drop.item,
-                owner=hero,
-                usages_left=drop.item.usages
-            )
-            dropped.append(drop.item.title)
-    update.message.reply_text("You got " + ", ".join(dropped))
-    job_queue.run_once(fight, 5, context=hero.id)
+    Action.notify(hero, f"You have encountered {mob_type.name}",
+                  markup=FIGHT_MARKUP)
+    return True
+
+def on_kill(bot, update, hero, fight):
+    mob_type = fight.mob_type
+    reply(update, f"You killed {mob_type.name}")
+    items = world.drop_table(mob_type.id).roll()
+    with settings.DB.atomic():
+        enter(hero, states.IDLE)
+        fights.end(fight, hero)
+        hero.save()
+        inventory.add(hero.id, items)
+    dropped = [item.title for item in items]
+    reply(update, "You got " + ", ".join(dropped))
+    scheduler.schedule_in("fight", combat.ENCOUNTER_DELAY, hero.id)
     actions(bot, update, hero)
 
-def on_death(bot, update, hero, mob, job_queue):
-    update.message.reply_text(f"You were killed by {mob.type.name}\nRespawn in {hero.respawn_time} secs")
-    hero.activity = Activity.create(type=Activity.RESPAWN, duration=hero.respawn_time)
-    hero.attacked_by = None
-    hero.save()
-    mob.delete_instance()
-    job_queue.run_once(revive, hero.respawn_time, context=hero.id)
-
-def handle_fight(bot, update, hero, job_queue):
-    action = update.message.text
-    mob = hero.attacked_by
-    reply_text = None
-    if action == 'Attack':
-        hero_dmg = hero.level * 10
-        reply_text = f"You hit {mob.type.name} with {hero_dmg} dmg"
-        if mob.hp_value - hero_dmg <= 0:
-            return on_kill(bot, update, hero, mob, job_queue)
-        mob.hp_value -= hero_dmg
-        mob.save()
-
-        if random.random() < mob.type.critical_chance:
-            mob_dmg = mob.type.critical
-        else:
-            mob_dmg = mob.type.damage
-        reply_text = f"{mob.type.name} hits you with {mob_dmg} dmg"
-        if hero.hp_value - mob_dmg <= 0:
-            return on_death(bot, update, hero, mob, job_queue)
-        hero.hp_value -= mob_dmg
+def on_death(bot, update, hero, fight):
+    reply(update, f"You were killed by {fight.mob_type.name}\nRespawn in {hero.respawn_time} secs")
+    with settings.DB.atomic():
+        fights.end(fight, hero)
+        hero.activity = Activity.begin(Activity.RESPAWN, hero.respawn_time)
         hero.save()
-    elif action == 'Guard':
-        reply_text = f"You block next attack with a shield"
-        if random.random() < mob.type.critical_chance:
-            mob_dmg = mob.type.critical
-        else:
-            mob_dmg = mob.type.damage
-        mob_dmg = max(0, mob_dmg - hero.level * 10)  # replace with shield def
-        reply_text += f"\n{mob.type.name} hits you with {mob_dmg} dmg"
-        if hero.hp_value - mob_dmg <= 0:
-            return on_death(bot, update, hero, mob, job_queue)
-        hero.hp_value -= mob_dmg
+    if not settings.LAZY_ACTIVITIES:
+        scheduler.schedule("revive", hero.activity.due_time, hero.id)
+
+@machine.on('FIGHT', 'Attack')
+def attack(bot, update, hero, rest):
+    fight = fights.get(hero)
+    result = combat.attack(fight.hero_hp, fight.mob_hp, hero.level, fight.mob_type)
+    return fight_round(bot, update, hero, fight, result,
+                       f"You hit {fight.mob_type.name} with {result.hero_dmg} dmg")
+
+@machine.on('FIGHT', 'Guard')
+def guard(bot, update, hero, rest):
+    fight = fights.get(hero)
+    result = combat.guard(fight.hero_hp, fight.mob_hp, hero.level, fight.mob_type)
+    return fight_round(bot, update, hero, fight, result, "You block next attack with a shield")
+
+@machine.on('FIGHT', 'Run away')
+def run_away(bot, update, hero, rest):
+    fight = fights.get(hero)
+    reply(update, "You ran in fear.")
+    with settings.DB.atomic():
+        enter(hero, states.IDLE)
+        fights.end(fight, hero)
         hero.save()
-    elif action == 'Run away':
-        update.message.reply_text("You ran in fear.")
-        hero.state = HeroState.get(name='IDLE')
-        hero.attacked_by = None
-        hero.save()
-        mob.delete_instance()
-        return actions(bot, update, hero)
-    else:
-        update.message.reply_text(f"Can't {action} now")
-    reply_text += f"\nYour HP: {hero.hp_value}\n{mob.type.name} HP: {mob.hp_value}"
-    update.message.reply_text(reply_text)
+    return actions(bot, update, hero)
+
+@machine.on('FIGHT')
+def cant_fight(bot, update, hero, action):
+    reply(update, f"Can't {action} now")
+
+def fight_round(bot, update, hero, fight, result, reply_text):
+    mob_type = fight.mob_type
+    if result.outcome == combat.KILL:
+        return on_kill(bot, update, hero, fight)
+    reply_text += f"\n{mob_type.name} hits you with {result.mob_dmg} dmg"
+    if result.outcome == combat.DEATH:
+        return on_death(bot, update, hero, fight)
+    fights.record(fight, result)
+    reply_text += f"\nYour HP: {fight.hero_hp}\n{mob_type.name} HP: {fight.mob_hp}"
+    reply(update, reply_text)
 
 
 def shop_actions(bot, update, hero):
-    instances = ItemInstance.select(ItemInstance.type).distinct().where(ItemInstance.owner == hero)
-    actions = ReplyKeyboardMarkup(
-        [
-            [f"Buy '{slot.item.title}'" for slot in hero.location.shop_slots],
-            [f"Sell '{instance.type.title}'" for instance in instances],
-            ["Leave"]
-        ],
-        one_time_keyboard=True,
-        resize_keyboard=True
-    )
-    update.message.reply_text(
+    owned = inventories.get((hero.id, hero.inventory_version),
+                            lambda: tuple(inventory.item_types(hero.id)))
+    stocked = shop.stock_view.in_stock(hero.location_id)
+    actions = keyboards.get(("shop", world.version, stocked, owned), lambda: markup([
+        [f"Buy '{world.item(item_id).title}'" for item_id in stocked],
+        [f"Sell '{world.item(type_id).title}'" for type_id in owned],
+        ["Leave"]
+    ]))
+    reply(update,
         f"You have {hero.gold} gold. What do you want?",
         reply_markup=actions
     )
 
 
-def handle_shopping(bot, update, hero, job_queue):
-    action = update.message.text.split(" ", 1)
-    if len(action) == 1 and action[0].lower() == "leave":
-        hero.state = HeroState.get(name="IDLE")
-        hero.save()
-        return actions(bot, update, hero)
-    if len(action) != 2:
-        update.message.reply_text("I didn't understood you")
+def back_to_idle(bot, update, hero):
+    enter(hero, states.IDLE)
+    hero.save()
+    # encounters skip heroes who are busy, so a skipped one is due again
+    if hero.location.type == Location.FIGHT:
+        scheduler.schedule_in("fight", combat.ENCOUNTER_DELAY, hero.id)
+    return actions(bot, update, hero)
+
+@machine.on('SHOPPING', 'Leave')
+def leave_shop(bot, update, hero, rest):
+    return back_to_idle(bot, update, hero)
+
+@machine.on('SHOPPING', 'Buy')
+def buy(bot, update, hero, rest):
+    order = shop.parse_order(rest)
+    if order is None:
+        return not_understood(bot, update, hero, rest)
+    count, request = order
+    requested_item = world.item_by_title(request)
+    if requested_item is None:
+        reply(update, f"Cannot find item '{request}'")
         return shop_actions(bot, update, hero)
-    action, request = action
-    try:
-        request = request[1:-1]
-        requested_item = Item.get(title=request)
-    except Item.DoesNotExist:
-        update.message.reply_text(f"Cannot find item '{request}'")
+    trade = shop.buy(hero.id, hero.location_id, requested_item.id, count)
+    if trade.status == shop.OK:
+        hero.gold = trade.gold
+        hero.inventory_version = trade.inventory_version
+        reply(update, f"You bought '{requested_item.title}'" + (f" x{count}" if count > 1 else ""))
+    elif trade.status == shop.NO_MONEY:
+        reply(update, f"You don't have enough money, you have: {trade.gold}, needed: {trade.price * count}")
     else:
-        shop_location = hero.location
-        if action.lower() == "buy":
-            updated = ShopSlot.update(count=ShopSlot.count - 1).where(
-                (ShopSlot.count > 0) &
-                (ShopSlot.item == requested_item) &
-                (ShopSlot.location == shop_location)
-            ).execute()
-            if updated == 1:
-                slot = ShopSlot.get(item=requested_item)
-                updated = Hero.update(gold=Hero.gold - slot.price).where(
-                    (Hero.id == hero.id) &
-                    (Hero.gold >= slot.price)
-                ).execute()
-                if updated == 1:
-                    item = ItemInstance.create(
-                        type=requested_item,
-                        owner=hero,
-                        usages_left=requested_item.usages
-                    )
-                    update.message.reply_text(f"You bought '{item.type.title}'")
-                    if slot.count == 0:
-                        slot.delete_instance()
-                else:
-                    update.message.reply_text(
-                        f"You don't have enough money, you have: {hero.gold}, needed: {slot.price}"
-                    )
-                    ShopSlot.update(count=ShopSlot.count + 1).where(
-                        (ShopSlot.item == requested_item) &
-                        (ShopSlot.location == shop_location)
-                    ).execute()
-            else:
-                update.message.reply_text(f"Shop has no item '{request}'")
-        elif action.lower() == "sell":
-            item_inst = None
-            for item in hero.items:
-                if item.type == requested_item:
-                    item_inst = item
-                    break
-            if item_inst is None:
-                update.message.reply_text(f"You don't have '{requested_item.title}'")
-            else:
-                _, created = ShopSlot.get_or_create(item=requested_item, location=shop_location, defaults={
-                    "price": item_inst.type.price,
-                    "count": 1
-                })
-                if not created:
-                    with settings.DB.atomic():
-                        ShopSlot.update(count=ShopSlot.count + 1).where(
-                            (ShopSlot.item == requested_item) &
-                            (ShopSlot.location == shop_location)
-                        ).execute()
-                        item_inst.delete_instance()
-                        Hero.update(gold=Hero.gold + item_inst.type.price).where(Hero.id == hero.id).execute()
-                update.message.reply_text(f"You sold '{item_inst.type.title}'")
-        else:
-            update.message.reply_text("I didn't understood you")
-    hero = Hero.get(id=hero.id)
+        reply(update, f"Shop has no item '{request}'")
+    return shop_actions(bot, update, hero)
+
+@machine.on('SHOPPING', 'Sell')
+def sell(bot, update, hero, rest):
+    order = shop.parse_order(rest, allow_all=True)
+    if order is None:
+        return not_understood(bot, update, hero, rest)
+    count, request = order
+    requested_item = world.item_by_title(request)
+    if requested_item is None:
+        reply(update, f"Cannot find item '{request}'")
+        return shop_actions(bot, update, hero)
+    trade = shop.sell(hero.id, hero.location_id, requested_item.id, count)
+    if trade.status == shop.OK:
+        hero.gold = trade.gold
+        hero.inventory_version = trade.inventory_version
+        reply(update, f"You sold '{requested_item.title}'" + (f" x{trade.count}" if trade.count > 1 else ""))
+    else:
+        reply(update, f"You don't have '{requested_item.title}'")
+    return shop_actions(bot, update, hero)
+
+@machine.on('SHOPPING')
+def not_understood(bot, update, hero, rest):
+    reply(update, "I didn't understood you")
     return shop_actions(bot, update, hero)
 
 @registered
 def cancel(bot, update, hero):
-    if hero.state.name == 'IDLE':
-        update.message.reply_text("There's nothing to cancel")
-    elif hero.state.name == 'FIGHT':
-        update.message.reply_text("Can't cancel a fight")
-    elif hero.state.name == 'TRAVEL':
-        hero.state = HeroState.get(name='IDLE')
-        hero.save()
-        return actions(bot, update, hero)
+    state = states.name_of(hero.state_id)
+    if state == 'IDLE':
+        reply(update, "There's nothing to cancel")
+    elif state == 'FIGHT':
+        reply(update, "Can't cancel a fight")
+    elif state in ('TRAVEL', 'SHOPPING'):
+        return back_to_idle(bot, update, hero)
 
 @registered
 def show_inventory(bot, update, hero):
-    items = Hero.get(chat_id=update.effective_chat.id).items
-    listing = '\n'.join([f"{item.type.title}" for item in items])
+    listing = '\n'.join([
+        f"{world.item(stack.type_id).title}" + (f" x{stack.quantity}" if stack.quantity > 1 else "")
+        for stack in inventory.stacks(hero.id)
+    ])
     if listing == '':
-        update.message.reply_text('Your inventory is empty')
+        reply(update, 'Your inventory is empty')
     else:
-        update.message.reply_text(listing)
+        reply(update, listing)
 
 @registered
-def reactor(bot, update, hero, job_queue):
+def reactor(bot, update, hero):
     if hero.activity:
         if hero.activity.type == Activity.RESPAWN:
             remaining = (hero.activity.start_time + datetime.timedelta(seconds=hero.activity.duration)) - datetime.datetime.now()
             assert remaining.seconds >= 0
-            update.message.reply_text(f"Your hero is dead. Respawn in {remaining.seconds} seconds")
+            reply(update, f"Your hero is dead. Respawn in {remaining.seconds} seconds")
     else:
-        handlers[hero.state.name](bot, update, hero, job_queue)
-
-handlers = {'IDLE': handle_actions,
-            'TRAVEL': handle_travel,
-            'FIGHT': handle_fight,
-            'SHOPPING': handle_shopping}
-
-updater = Updater(env("API_TOKEN"))
-
-updater.dispatcher.add_handler(MessageHandler(Filters.text, reactor, pass_job_queue=True))
-updater.dispatcher.add_handler(CommandHandler('register', register, pass_args=True, pass_job_queue=True))
-updater.dispatcher.add_handler(CommandHandler('start', start))
-updater.dispatcher.add_handler(CommandHandler('cancel', cancel))
-updater.dispatcher.add_handler(CommandHandler('inventory', show_inventory))
-
-updater.start_polling()
-updater.idle()
+        try:
+            machine.dispatch(bot, update, hero)
+        except IllegalTransition as e:
+            logger.warning("hero %s: illegal transition %s", hero.id, e)
+            reply(update, "You can't do that now")
+
+ACTIVITY_TIMERS = {Activity.HEALING: "heal", Activity.RESPAWN: "revive"}
+
+def restore_timers(shard=0, shards=1):
+    # Pending heals and respawns live in the activity table; heroes idling in
+    # a fight location only need their next encounter, so they get one now.
+    # A webhook shard only restores the timers of its own heroes.
+    if settings.LAZY_ACTIVITIES:
+        timers = [(datetime.datetime.now(), "sweep", None)] if shard == 0 else []
+    else:
+        watermark = last_activity()
+        timers = [(due, ACTIVITY_TIMERS[type], hero_id)
+                  for hero_id, type, due in pending_activities(shard, shards)]
+        timers.append((datetime.datetime.now() + datetime.timedelta(seconds=settings.ACTIVITY_POLL_INTERVAL),
+                       "poll", (watermark, shard, shards)))
+    fight_locations = [location.id for location in world.snapshot.locations.values()
+                       if location.type == Location.FIGHT]
+    if fight_locations:
+        now = datetime.datetime.now()
+        idle = Hero.select(Hero.id).where(
+            (Hero.state == states.IDLE) &
+            (Hero.activity.is_null()) &
+            (Hero.location << fight_locations)
+        )
+        if shards > 1:
+            idle = idle.where(of_shard(shard, shards))
+        idle = idle.tuples()
+        timers.extend((now, "fight", hero_id) for hero_id, in idle)
+    scheduler.schedule_many(timers)
+    logger.info("restored %d timers", len(timers))
+
+scheduler.register("heal", do_heal)
+scheduler.register("revive", revive)
+scheduler.register("fight", fight)
+scheduler.register("sweep", sweep)
+scheduler.register("poll", poll_activities)
+
+def build_updater():
+    updater = Updater(env("API_TOKEN"), base_url=settings.TELEGRAM_API_URL)
+    updater.dispatcher.add_handler(MessageHandler(Filters.text, reactor))
+    updater.dispatcher.add_handler(CommandHandler('register', register, pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler('start', start))
+    updater.dispatcher.add_handler(CommandHandler('cancel', cancel))
+    updater.dispatcher.add_handler(CommandHandler('inventory', show_inventory))
+    updater.dispatcher.add_handler(CommandHandler('goto', goto, pass_args=True))
+    return updater
+
+def main(mode):
+    if mode == "webhook":
+        return serve_webhook()
+    serve(build_updater(), mode)
+
+def start_services(updater, shard=0, shards=1):
+    metrics_file, labels = settings.METRICS_FILE, None
+    if shards > 1:
+        # every shard sends on its own, so each gets a share of the limit
+        outbound.limit_global(settings.SEND_GLOBAL_RATE / shards)
+        delivery.shard, delivery.shards = shard, shards
+        metrics_file = metrics_file and f"{metrics_file}.{shard}"
+        labels = {"shard": shard}
+    instrument_db(settings.DB)
+    instrument_dispatcher(updater.dispatcher)
+    Reporter(settings.DB, metrics_file, settings.METRICS_INTERVAL, labels).start()
+    world.load()
+    states.load()
+    restore_timers(shard, shards)
+    outbound.start(updater.bot)
+    delivery.start()
+    scheduler.start(updater.bot)
+
+def serve_webhook():
+    shards = settings.WEBHOOK_WORKERS
+    record = open(settings.WEBHOOK_RECORD, "a") if settings.WEBHOOK_RECORD else None
+    webhook = WebhookServer(settings.WEBHOOK_HOST, settings.WEBHOOK_PORT, settings.WEBHOOK_SECRET,
+                            shards, record=record)
+    webhook.start_workers(run_shard)
+    if settings.WEBHOOK_URL:
+        bot = Bot(env("API_TOKEN"), base_url=settings.TELEGRAM_API_URL)
+        bot.set_webhook(url=f"{settings.WEBHOOK_URL.rstrip('/')}/{settings.WEBHOOK_SECRET}")
+    logger.info("webhook listening on %s:%s with %d workers",
+                settings.WEBHOOK_HOST, settings.WEBHOOK_PORT, shards)
+    webhook.serve_forever()
+
+def run_shard(shard, shards, updates):
+    updater = build_updater()
+    start_services(updater, shard, shards)
+
+    def process(data):
+        try:
+            updater.dispatcher.process_update(Update.de_json(data, updater.bot))
+        finally:
+            if not settings.DB.is_closed():
+                settings.DB.close()
+
+    consume(updates, process)
+
+def serve(updater, mode):
+    start_services(updater)
+    if mode == "polling":
+        updater.start_polling()
+        updater.idle()
+    elif mode == "async":
+        AsyncRuntime(updater.bot, updater.dispatcher, settings.ASYNC_WORKERS).run()
+    else:
+        print(f"unknown mode {mode}, expected polling, async or webhook")
+        exit(1)
 
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "polling")
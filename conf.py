@@ -1,21 +1,76 @@
 import os
 import re
 from envparse import env
-from peewee import PostgresqlDatabase
+from playhouse.pool import PooledPostgresqlDatabase
 
 env.read_envfile()
 
 
 class Settings:
-    DB = PostgresqlDatabase(
+    DB = PooledPostgresqlDatabase(
         database=env("DB_NAME"),
         user=env("DB_USER"),
         password=env("DB_PASSWORD"),
         host=env("DB_HOST"),
+        max_connections=env.int("DB_MAX_CONNECTIONS", default=16),
+        stale_timeout=env.int("DB_STALE_TIMEOUT", default=300),
         autorollback=True
     )
 
+    # base of the Bot API urls (the token is appended), e.g. a local stand-in
+    # such as runtime/fake_telegram.py: http://127.0.0.1:8081/bot
+    TELEGRAM_API_URL = env("TELEGRAM_API_URL", default=None)
+    # handler threads of the asyncio runtime; keep below DB_MAX_CONNECTIONS
+    ASYNC_WORKERS = env.int("ASYNC_WORKERS", default=8)
+
+    # outbound messages per second: Telegram allows about 30 overall and
+    # one per chat (with short bursts)
+    SEND_GLOBAL_RATE = env.float("SEND_GLOBAL_RATE", default=30)
+    SEND_CHAT_RATE = env.float("SEND_CHAT_RATE", default=1)
+    SEND_CHAT_BURST = env.int("SEND_CHAT_BURST", default=3)
+    SEND_WORKERS = env.int("SEND_WORKERS", default=4)
+
+    # delivery of queued Action rows (timer notifications)
+    OUTBOX_WORKERS = env.int("OUTBOX_WORKERS", default=1)
+    OUTBOX_BATCH = env.int("OUTBOX_BATCH", default=500)
+    OUTBOX_INTERVAL = env.float("OUTBOX_INTERVAL", default=1.0)
+    # claimed but unsent rows are claimed again after this many seconds
+    OUTBOX_LEASE = env.float("OUTBOX_LEASE", default=300)
+
     SESSION_COOKIE_SECRET_KEY = env("SESSION_COOKIE_SECRET_KEY")
     SECRET_KEY = env("SECRET_KEY")
 
+    # how often (seconds) the bot checks whether the admin changed the world
+    WORLD_REFRESH_INTERVAL = env.float("WORLD_REFRESH_INTERVAL", default=5.0)
+
+    # finish heals and respawns when the hero is next touched instead of
+    # keeping a timer per hero; a periodic sweep sends the notifications
+    LAZY_ACTIVITIES = env.bool("LAZY_ACTIVITIES", default=False)
+    ACTIVITY_SWEEP_INTERVAL = env.float("ACTIVITY_SWEEP_INTERVAL", default=10.0)
+    ACTIVITY_SWEEP_BATCH = env.int("ACTIVITY_SWEEP_BATCH", default=500)
+    # eager mode: how often to pick up activities created outside the bot (admin)
+    ACTIVITY_POLL_INTERVAL = env.float("ACTIVITY_POLL_INTERVAL", default=30.0)
+
+    # seconds a shop's stock (its buy buttons) may be out of date
+    STOCK_REFRESH_INTERVAL = env.float("STOCK_REFRESH_INTERVAL", default=2.0)
+
+    # rounds between writes of a running fight's HP values to the database
+    COMBAT_CHECKPOINT_ROUNDS = env.int("COMBAT_CHECKPOINT_ROUNDS", default=5)
+
+    # `bot.py webhook`: Telegram posts to WEBHOOK_URL/WEBHOOK_SECRET, which
+    # should reach WEBHOOK_HOST:WEBHOOK_PORT; chats are split over
+    # WEBHOOK_WORKERS processes. WEBHOOK_RECORD appends incoming updates to
+    # a file that runtime/replay.py can post again.
+    WEBHOOK_HOST = env("WEBHOOK_HOST", default="127.0.0.1")
+    WEBHOOK_PORT = env.int("WEBHOOK_PORT", default=8443)
+    WEBHOOK_SECRET = env("WEBHOOK_SECRET", default="updates")
+    WEBHOOK_URL = env("WEBHOOK_URL", default=None)
+    WEBHOOK_WORKERS = env.int("WEBHOOK_WORKERS", default=4)
+    WEBHOOK_RECORD = env("WEBHOOK_RECORD", default=None)
+
+    # the bot writes its metrics to this file every METRICS_INTERVAL seconds
+    # (and logs a summary); the admin serves it on /metrics
+    METRICS_FILE = env("METRICS_FILE", default=None)
+    METRICS_INTERVAL = env.float("METRICS_INTERVAL", default=60.0)
+
 settings = Settings()
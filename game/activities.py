@@ -0,0 +1,67 @@
+import datetime
+import random
+from conf import settings
+from game.models import Hero, Activity
+from game.states import states
+from game.fsm import check, enter
+from game.world import world
+
+
+def due_time(activity):
+    if activity.due_time is not None:
+        return activity.due_time
+    return activity.start_time + datetime.timedelta(seconds=activity.duration)
+
+
+def is_expired(activity, now=None):
+    return due_time(activity) <= (now or datetime.datetime.now())
+
+
+def finish_healing(hero):
+    return _finish(hero, Activity.HEALING, hp_value=hero.hp_base)
+
+
+def finish_respawn(hero):
+    return _finish(hero, Activity.RESPAWN, hp_value=hero.hp_base,
+                   location=random.choice(world.start_locations()))
+
+
+finishers = {
+    Activity.HEALING: finish_healing,
+    Activity.RESPAWN: finish_respawn,
+}
+
+
+def resolve_expired(hero, now=None):
+    # Materialize a finished activity; returns its type, or None if the hero
+    # had nothing to finish or someone else finished it first.
+    activity = hero.activity
+    if activity is None or not is_expired(activity, now):
+        return None
+    if finishers[activity.type](hero):
+        return activity.type
+    return None
+
+
+def _finish(hero, activity_type, **changes):
+    activity = hero.activity
+    if activity is None or activity.type != activity_type:
+        return False
+    check(hero, states.IDLE)
+    with settings.DB.atomic():
+        # The activity may be finished concurrently by a timer, the sweep and
+        # the hero's own next message; only the one clearing it may apply it.
+        claimed = Hero.update(activity=None, state=states.IDLE.id, **changes).where(
+            (Hero.id == hero.id) &
+            (Hero.activity == activity.id)
+        ).execute()
+        if not claimed:
+            # whoever won already applied (and announced) their own outcome;
+            # leave the hero as loaded so a later save can't overwrite it
+            return False
+        Activity.delete().where(Activity.id == activity.id).execute()
+    enter(hero, states.IDLE)
+    for name, value in changes.items():
+        setattr(hero, name, value)
+    hero.activity = None
+    return True
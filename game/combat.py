@@ -0,0 +1,56 @@
+import random
+from collections import namedtuple
+
+# Combat rules, free of database and Telegram so the bot and the balancing
+# simulator (game/simulate.py) share them.
+
+DAMAGE_PER_LEVEL = 10
+GUARD_PER_LEVEL = 10  # replace with shield def
+ENCOUNTER_DELAY = 5
+
+
+def hero_damage(level):
+    return level * DAMAGE_PER_LEVEL
+
+
+def mob_damage(mob, rng=random):
+    if rng.random() < mob.critical_chance:
+        return mob.critical
+    return mob.damage
+
+
+def guarded(damage, level):
+    return max(0, damage - level * GUARD_PER_LEVEL)
+
+
+def respawn_time(level):
+    return 5 + 5 * level
+
+
+def recover_time(missing_hp):
+    return 15 * missing_hp / 5
+
+
+ONGOING = 0
+KILL = 1
+DEATH = 2
+
+# hero_dmg is None when the hero didn't strike, mob_dmg when the mob didn't
+Round = namedtuple("Round", ["outcome", "hero_dmg", "mob_dmg", "hero_hp", "mob_hp"])
+
+
+def attack(hero_hp, mob_hp, level, mob, rng=random):
+    hero_dmg = hero_damage(level)
+    if mob_hp - hero_dmg <= 0:
+        return Round(KILL, hero_dmg, None, hero_hp, 0)
+    return _mob_strikes(hero_hp, mob_hp - hero_dmg, hero_dmg, mob_damage(mob, rng))
+
+
+def guard(hero_hp, mob_hp, level, mob, rng=random):
+    return _mob_strikes(hero_hp, mob_hp, None, guarded(mob_damage(mob, rng), level))
+
+
+def _mob_strikes(hero_hp, mob_hp, hero_dmg, mob_dmg):
+    if hero_hp - mob_dmg <= 0:
+        return Round(DEATH, hero_dmg, mob_dmg, 0, mob_hp)
+    return Round(ONGOING, hero_dmg, mob_dmg, hero_hp - mob_dmg, mob_hp)
@@ -0,0 +1,103 @@
+import datetime
+import json
+from functools import lru_cache
+from game import inventory
+
+# Gateway conditions, all keys must hold:
+#   {"min_level": 5, "min_gold": 100, "item": <item id>, "hours": [22, 4]}
+# "hours" is a [from, to) window of the hour of day and may wrap midnight.
+# An empty or missing condition always passes.
+
+KEYS = ("min_level", "min_gold", "item", "hours")
+
+
+class Condition:
+    __slots__ = ("checks", "needs_items")
+
+    def __init__(self, checks, needs_items):
+        self.checks = checks
+        self.needs_items = needs_items
+
+    def __call__(self, hero, items=None, now=None):
+        now = now or datetime.datetime.now()
+        return all(check(hero, items, now) for check in self.checks)
+
+
+# stands in for conditions that don't compile, so a typo in the admin
+# closes the gateway instead of opening it
+CLOSED = Condition((lambda hero, items, now: False,), False)
+
+
+def in_window(hour, start, end):
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def _min_level(level):
+    return lambda hero, items, now: hero.level >= level
+
+
+def _min_gold(gold):
+    return lambda hero, items, now: hero.gold >= gold
+
+
+def _item(item_id):
+    return lambda hero, items, now: item_id in items
+
+
+def _hours(start, end):
+    return lambda hero, items, now: in_window(now.hour, start, end)
+
+
+def validate(condition):
+    if not condition:
+        return
+    if not isinstance(condition, dict):
+        raise ValueError("condition must be an object")
+    unknown = set(condition) - set(KEYS)
+    if unknown:
+        raise ValueError(f"unknown condition keys: {', '.join(sorted(unknown))}")
+    for key in ("min_level", "min_gold", "item"):
+        if key in condition and not isinstance(condition[key], int):
+            raise ValueError(f"{key} must be an integer")
+    if "hours" in condition:
+        hours = condition["hours"]
+        if (not isinstance(hours, list) or len(hours) != 2 or
+                not all(isinstance(hour, int) and 0 <= hour <= 24 for hour in hours)):
+            raise ValueError("hours must be [from, to] with hours of day")
+
+
+def compiled(condition):
+    # gateways with equal conditions share one compiled predicate
+    return _compiled(json.dumps(condition or {}, sort_keys=True))
+
+
+@lru_cache(maxsize=1024)
+def _compiled(text):
+    condition = json.loads(text)
+    validate(condition)
+    checks = []
+    if "min_level" in condition:
+        checks.append(_min_level(condition["min_level"]))
+    if "min_gold" in condition:
+        checks.append(_min_gold(condition["min_gold"]))
+    if "item" in condition:
+        checks.append(_item(condition["item"]))
+    if "hours" in condition:
+        checks.append(_hours(*condition["hours"]))
+    return Condition(tuple(checks), "item" in condition)
+
+
+def blocked(gateways, hero, now=None):
+    # ids of the gateways the hero can't pass; the inventory is only read
+    # if one of them asks for an item
+    gated = [gateway for gateway in gateways if gateway.check.checks]
+    if not gated:
+        return frozenset()
+    items = None
+    if any(gateway.check.needs_items for gateway in gated):
+        items = set(inventory.item_types(hero.id))
+    now = now or datetime.datetime.now()
+    return frozenset(gateway.id for gateway in gated if not gateway.check(hero, items, now))
+
@@ -0,0 +1,146 @@
+import logging
+import random
+from collections import namedtuple
+from conf import settings
+from game.models import LocationGroup, Location, LocationGateway, MobDwells, ShopSlot, WorldVersion
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+# Generated in memory first, rooms referred to by index (0 is the entrance),
+# then persisted with ids reserved up front, so nothing has to be read back.
+Room = namedtuple("Room", ["type", "depth", "name", "description"])
+Dungeon = namedtuple("Dungeon", ["name", "rooms", "links", "dwellings", "shop_slots"])
+
+ROOM_WEIGHTS = ((Location.FIGHT, 0.7), (Location.HEALING, 0.15), (Location.SHOP, 0.15))
+
+DESCRIPTIONS = {
+    Location.FIGHT: ("Bones crunch under your feet.", "Something breathes in the dark.",
+                     "Claw marks cover the walls."),
+    Location.HEALING: ("A clear spring trickles from the rock.", "Someone left a campfire burning."),
+    Location.SHOP: ("A hooded trader has set up shop here.", "A goblin peddler eyes your purse."),
+}
+KINDS = {Location.FIGHT: "Hall", Location.HEALING: "Spring", Location.SHOP: "Trader"}
+
+
+def strength(mob):
+    # expected damage it takes to kill the mob times what it deals per round
+    return mob.hp_base * (mob.damage + mob.critical * mob.critical_chance)
+
+
+def _room_type(rng):
+    roll = rng.random()
+    for type, weight in ROOM_WEIGHTS:
+        if roll < weight:
+            return type
+        roll -= weight
+    return Location.FIGHT
+
+
+def generate(rooms, mobs, items, seed=None, loops=0.15, name="Dungeon"):
+    if rooms < 2:
+        raise ValueError("a dungeon needs at least 2 rooms")
+    if not mobs:
+        raise ValueError("no mobs to populate the dungeon with")
+    rng = random.Random(seed)
+
+    # Random recursive tree; parents are picked among the last few rooms so
+    # the dungeon grows deep instead of into one wide star.
+    depths = [0]
+    links = set()
+    for room in range(1, rooms):
+        parent = rng.randrange(max(0, room - 3), room)
+        depths.append(depths[parent] + 1)
+        links.add((parent, room))
+    # extra links between rooms of about the same depth make loops
+    wanted, attempts = int((rooms - 1) * loops), 0
+    while wanted and attempts < rooms * 10:
+        attempts += 1
+        a, b = sorted(rng.sample(range(rooms), 2))
+        if (a, b) not in links and abs(depths[a] - depths[b]) <= 1:
+            links.add((a, b))
+            wanted -= 1
+
+    max_depth = max(depths)
+    deepest = depths.index(max_depth)
+    plan = []
+    for room, depth in enumerate(depths):
+        if room == 0:
+            type = Location.HEALING
+        elif room == deepest:
+            type = Location.FIGHT
+        else:
+            type = _room_type(rng)
+        plan.append(Room(type, depth, f"{name}, {KINDS[type]} {room + 1}", rng.choice(DESCRIPTIONS[type])))
+
+    # Mobs and goods get harder and pricier with depth: each room draws from
+    # a window of the sorted lists centered on its relative depth.
+    mobs = sorted(mobs, key=strength)
+    items = sorted(items, key=lambda item: item.price)
+    dwellings, shop_slots = [], []
+    for room, spec in enumerate(plan):
+        level = spec.depth / max_depth
+        if spec.type == Location.FIGHT:
+            center = round(level * (len(mobs) - 1))
+            window = mobs[max(0, center - 1):center + 2]
+            for mob in rng.sample(window, min(2, len(window))):
+                dwellings.append((room, mob.id, round(min(1.0, 0.3 + 0.6 * level), 2)))
+        elif spec.type == Location.SHOP and items:
+            top = max(1, round(level * len(items)))
+            for item in rng.sample(items[:top], min(3, top)):
+                shop_slots.append((room, item.id, rng.randint(1, 5), int(item.price * (1 + 0.1 * spec.depth))))
+    return Dungeon(name, plan, sorted(links), dwellings, shop_slots)
+
+
+def _reserve(model, count):
+    table = model._meta.db_table
+    cursor = settings.DB.execute_sql(
+        f"SELECT nextval(pg_get_serial_sequence('{table}', 'id')) FROM generate_series(1, %s)", (count,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _insert(model, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        model.insert_many(rows[start:start + BATCH_SIZE]).execute()
+
+
+def persist(dungeon, entrance=None):
+    # one transaction; entrance is an existing location id to link room 0 to
+    with settings.DB.atomic():
+        group_id, = _reserve(LocationGroup, 1)
+        ids = _reserve(Location, len(dungeon.rooms))
+        _insert(LocationGroup, [{"id": group_id, "type": LocationGroup.DUNGEON, "name": dungeon.name,
+                                 "description": f"{len(dungeon.rooms)} rooms, {len(dungeon.links)} passages"}])
+        _insert(Location, [
+            {"id": ids[n], "type": room.type, "name": room.name, "description": room.description,
+             "group": group_id, "is_enabled": True, "enter_price": 0}
+            for n, room in enumerate(dungeon.rooms)
+        ])
+        pairs = [(ids[a], ids[b]) for a, b in dungeon.links]
+        if entrance is not None:
+            pairs.append((entrance, ids[0]))
+        _insert(LocationGateway, [
+            {"from_location": source, "to_location": target, "condition": {}}
+            for a, b in pairs for source, target in ((a, b), (b, a))
+        ])
+        _insert(MobDwells, [{"location": ids[room], "mob": mob, "chance": chance}
+                            for room, mob, chance in dungeon.dwellings])
+        _insert(ShopSlot, [{"location": ids[room], "item": item, "count": count, "price": price}
+                           for room, item, count, price in dungeon.shop_slots])
+        WorldVersion.bump()
+    return group_id, ids
+
+
+def create(rooms, seed=None, entrance=None, loops=0.15, name=None):
+    from game.world import world
+
+    snapshot = world.snapshot
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    dungeon = generate(rooms, list(snapshot.mobs.values()), list(snapshot.items.values()),
+                       seed=seed, loops=loops, name=name or f"Dungeon {seed:x}")
+    group_id, ids = persist(dungeon, entrance)
+    logger.info("dungeon %s: group %s, %s rooms, seed %s", dungeon.name, group_id, len(ids), seed)
+    return group_id, ids
@@ -0,0 +1,73 @@
+import threading
+from conf import settings
+from game.models import Hero, MobInstance
+
+
+class Fight:
+    __slots__ = ("hero_id", "mob_id", "mob_type", "hero_hp", "mob_hp", "rounds")
+
+    def __init__(self, hero_id, mob_id, mob_type, hero_hp, mob_hp):
+        self.hero_id = hero_id
+        self.mob_id = mob_id
+        self.mob_type = mob_type
+        self.hero_hp = hero_hp
+        self.mob_hp = mob_hp
+        self.rounds = 0
+
+
+# Running fights live in memory. The database sees the MobInstance row at
+# the start, a checkpoint of both HP values every `checkpoint_every` rounds
+# and the cleanup at the end; after a crash a fight resumes from its last
+# checkpoint via hero.attacked_by.
+class FightStore:
+    def __init__(self, checkpoint_every):
+        self.checkpoint_every = checkpoint_every
+        self._fights = {}
+        self._lock = threading.Lock()
+
+    def start(self, hero, mob_type):
+        mob = MobInstance.create(type=mob_type, hp_value=mob_type.hp_base)
+        hero.attacked_by = mob
+        fight = Fight(hero.id, mob.id, mob_type, hero.hp_value, mob.hp_value)
+        with self._lock:
+            self._fights[hero.id] = fight
+        return fight
+
+    def get(self, hero):
+        with self._lock:
+            fight = self._fights.get(hero.id)
+        if fight is not None and fight.mob_id == hero.attacked_by_id:
+            return fight
+        mob = hero.attacked_by
+        if mob is None:
+            return None
+        fight = Fight(hero.id, mob.id, mob.type, hero.hp_value, mob.hp_value)
+        with self._lock:
+            self._fights[hero.id] = fight
+        return fight
+
+    def record(self, fight, result):
+        fight.hero_hp = result.hero_hp
+        fight.mob_hp = result.mob_hp
+        fight.rounds += 1
+        if fight.rounds % self.checkpoint_every == 0:
+            self.checkpoint(fight)
+
+    def checkpoint(self, fight):
+        with settings.DB.atomic():
+            MobInstance.update(hp_value=fight.mob_hp).where(MobInstance.id == fight.mob_id).execute()
+            Hero.update(hp_value=fight.hero_hp).where(Hero.id == fight.hero_id).execute()
+
+    def end(self, fight, hero):
+        # the caller saves the rest of the hero; the reference to the mob has
+        # to be gone before its row is, the foreign key isn't deferrable
+        with self._lock:
+            if self._fights.get(fight.hero_id) is fight:
+                del self._fights[fight.hero_id]
+        hero.hp_value = fight.hero_hp
+        hero.attacked_by = None
+        Hero.update(attacked_by=None).where(Hero.id == hero.id).execute()
+        MobInstance.delete().where(MobInstance.id == fight.mob_id).execute()
+
+    def __len__(self):
+        return len(self._fights)
@@ -0,0 +1,88 @@
+import logging
+import re
+from game.states import states
+
+logger = logging.getLogger(__name__)
+
+
+class IllegalTransition(Exception):
+    def __init__(self, from_state, to_state):
+        super().__init__(f"{from_state} -> {to_state}")
+        self.from_state = from_state
+        self.to_state = to_state
+
+
+def check(hero, state):
+    # staying in a state is always allowed
+    if hero.state_id != state.id and not states.can_transition(hero.state_id, state):
+        raise IllegalTransition(states.name_of(hero.state_id), state.name)
+
+
+def enter(hero, state):
+    # the only way handlers change a hero's state: checked against
+    # HeroStateTransition in memory, before anything is written
+    check(hero, state)
+    hero.state = state
+
+
+# Button texts of one state, word by word and case-insensitive. A message
+# goes to the command with the longest matching prefix of words and the
+# rest of the text becomes its argument: "Buy 2 'Plain Sword'" -> buy("2
+# 'Plain Sword'").
+class CommandTrie:
+    def __init__(self):
+        self._root = {}
+        self.fallback = None
+
+    def add(self, command, handler):
+        node = self._root
+        for word in command.lower().split():
+            node = node.setdefault(word, {})
+        node[None] = handler
+
+    def match(self, text):
+        node = self._root
+        found, end = None, 0
+        for word in re.finditer(r"\S+", text):
+            node = node.get(word.group().lower())
+            if node is None:
+                break
+            if None in node:
+                found, end = node[None], word.end()
+        if found is None:
+            return self.fallback, text
+        return found, text[end:].strip()
+
+
+# Per-state command tables, declared next to the handlers:
+#
+#   @machine.on("FIGHT", "Attack")
+#   def attack(bot, update, hero, rest): ...
+#
+# A handler registered without commands gets everything the others don't.
+# `wrap` is applied to every registered handler (e.g. metrics.timed).
+class StateMachine:
+    def __init__(self, wrap=None):
+        self.wrap = wrap
+        self._tries = {}
+
+    def on(self, state, *commands):
+        def decorator(handler):
+            wrapped = self.wrap(handler) if self.wrap else handler
+            trie = self._tries.setdefault(state, CommandTrie())
+            if not commands:
+                trie.fallback = wrapped
+            for command in commands:
+                trie.add(command, wrapped)
+            return handler
+        return decorator
+
+    def dispatch(self, bot, update, hero):
+        state = states.name_of(hero.state_id)
+        trie = self._tries.get(state)
+        if trie is None:
+            logger.warning("no commands in state %s", state)
+            return
+        handler, rest = trie.match(update.message.text)
+        if handler is not None:
+            return handler(bot, update, hero, rest)
@@ -0,0 +1,83 @@
+import datetime
+from peewee import JOIN
+from conf import settings
+from game.activities import resolve_expired
+from game.models import Hero, Activity, MobInstance
+from game.states import states
+from game.fsm import check
+from game.world import world
+
+
+def load_hero(chat_id=None, hero_id=None):
+    # One round trip for the hero, its activity and the mob it fights;
+    # state, location and mob type come from the in-memory registries.
+    query = (Hero
+             .select(Hero, Activity, MobInstance)
+             .join(Activity, JOIN.LEFT_OUTER)
+             .switch(Hero)
+             .join(MobInstance, JOIN.LEFT_OUTER))
+    if chat_id is not None:
+        query = query.where(Hero.chat_id == chat_id)
+    else:
+        query = query.where(Hero.id == hero_id)
+    hero = query.get()
+    _attach_context(hero)
+    if settings.LAZY_ACTIVITIES:
+        resolve_expired(hero)
+    return hero
+
+
+def expired_heroes(limit, now=None):
+    # heroes whose activity is over, soonest first (activity.due_time index)
+    query = (Hero
+             .select(Hero, Activity)
+             .join(Activity)
+             .where(Activity.due_time <= (now or datetime.datetime.now()))
+             .order_by(Activity.due_time)
+             .limit(limit))
+    heroes = list(query)
+    for hero in heroes:
+        _attach_context(hero)
+    return heroes
+
+
+def move(hero, location, cost):
+    # Arrive and pay in one conditional update: fails if the hero can't
+    # afford it, or was moved or attacked (fight timer) in the meantime.
+    check(hero, states.IDLE)
+    moved = Hero.update(location=location.id, gold=Hero.gold - cost, state=states.IDLE.id).where(
+        (Hero.id == hero.id) &
+        (Hero.location == hero.location_id) &
+        (Hero.state == hero.state_id) &
+        (Hero.attacked_by.is_null()) &
+        (Hero.gold >= cost)
+    ).execute()
+    if not moved:
+        return False
+    hero._data["location"] = location.id
+    hero._data["gold"] = hero.gold - cost
+    hero._data["state"] = states.IDLE.id
+    _attach(hero, "location", location)
+    _attach(hero, "state", states.IDLE)
+    return True
+
+
+def _attach_context(hero):
+    _attach(hero, "state", states.by_id(hero.state_id))
+    _attach(hero, "location", world.location(hero.location_id))
+    if hero.activity_id is None:
+        _attach(hero, "activity", None)
+    if hero.attacked_by_id is None:
+        _attach(hero, "attacked_by", None)
+    else:
+        _attach(hero.attacked_by, "type", world.mob(hero.attacked_by.type_id))
+
+
+def _attach(instance, field, obj):
+    # Fill the relation cache directly: going through the descriptor would
+    # mark the foreign key as changed, and an all-NULL outer join must not
+    # leave an empty instance behind.
+    if obj is None:
+        instance._obj_cache.pop(field, None)
+    else:
+        instance._obj_cache[field] = obj
@@ -0,0 +1,41 @@
+from collections import Counter
+from conf import settings
+from game.models import ItemInstance
+
+ADD_SQL = """
+WITH bumped AS (
+    UPDATE hero SET inventory_version = inventory_version + 1 WHERE id = %s
+)
+INSERT INTO iteminstance (owner_id, type_id, usages_left, quantity)
+VALUES {}
+ON CONFLICT (owner_id, type_id, usages_left)
+DO UPDATE SET quantity = iteminstance.quantity + EXCLUDED.quantity
+"""
+
+
+def add(hero_id, items):
+    # items: Item instances, repeats allowed; one upsert for all of them
+    counts = Counter(items)
+    if not counts:
+        return
+    values = ", ".join(["(%s, %s, %s, %s)"] * len(counts))
+    params = [hero_id]
+    for item, quantity in counts.items():
+        params.extend((hero_id, item.id, item.usages, quantity))
+    settings.DB.execute_sql(ADD_SQL.format(values), params)
+
+
+def stacks(hero_id):
+    return list(ItemInstance
+                .select()
+                .where(ItemInstance.owner == hero_id)
+                .order_by(ItemInstance.type, ItemInstance.usages_left.desc()))
+
+
+def item_types(hero_id):
+    query = (ItemInstance
+             .select(ItemInstance.type)
+             .distinct()
+             .where(ItemInstance.owner == hero_id)
+             .tuples())
+    return [type_id for type_id, in query]
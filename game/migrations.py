@@ -0,0 +1,140 @@
+import logging
+from peewee import fn
+from conf import settings
+from game.models import SchemaVersion, WorldVersion
+
+logger = logging.getLogger(__name__)
+
+# Every migration must be safe to run against a database created from the
+# current models by `createdb`, which applies them all right after creating
+# the tables.
+MIGRATIONS = []
+
+# pg_advisory_xact_lock key, so two `0pg migrate` runs can't interleave
+MIGRATION_LOCK = 0x30706701
+
+
+def migration(version, description):
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+
+@migration(1, "create tables added after the initial schema")
+def create_new_tables(db):
+    WorldVersion.create_table(fail_silently=True)
+
+
+@migration(2, "index hero lookups and hot foreign keys")
+def index_hot_lookups(db):
+    db.execute_sql("ALTER TABLE hero ALTER COLUMN chat_id TYPE BIGINT")
+    db.execute_sql("CREATE UNIQUE INDEX IF NOT EXISTS hero_chat_id ON hero (chat_id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS iteminstance_owner_id ON iteminstance (owner_id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS mobdwells_location_id ON mobdwells (location_id)")
+    # shopslot is keyed by (location_id, item_id), which already covers location lookups
+    db.execute_sql("CREATE INDEX IF NOT EXISTS action_receiver_id_pending "
+                   "ON action (receiver_id) WHERE NOT is_notified")
+
+
+@migration(3, "persist activity due time for the timer scheduler")
+def add_activity_due_time(db):
+    db.execute_sql("ALTER TABLE activity ADD COLUMN IF NOT EXISTS due_time TIMESTAMP")
+    db.execute_sql("UPDATE activity SET due_time = start_time + duration * interval '1 second' "
+                   "WHERE due_time IS NULL")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS activity_due_time ON activity (due_time)")
+
+
+@migration(4, "deliver actions through an outbox")
+def add_action_outbox(db):
+    db.execute_sql("ALTER TABLE action ADD COLUMN IF NOT EXISTS markup TEXT")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS action_pending ON action (id) WHERE NOT is_notified")
+
+
+@migration(5, "index inventories by owner and item type")
+def index_inventory_types(db):
+    db.execute_sql("CREATE INDEX IF NOT EXISTS iteminstance_owner_id_type_id ON iteminstance (owner_id, type_id)")
+
+
+@migration(6, "stack identical inventory items")
+def stack_inventory(db):
+    db.execute_sql("ALTER TABLE iteminstance ADD COLUMN IF NOT EXISTS quantity INTEGER NOT NULL DEFAULT 1 "
+                   "CHECK (quantity > 0)")
+    # keep the oldest row of every (owner, type, usages) group, holding the group's total
+    db.execute_sql("""
+        WITH stacks AS (
+            SELECT min(id) AS id, owner_id, type_id, usages_left, sum(quantity) AS quantity
+            FROM iteminstance
+            GROUP BY owner_id, type_id, usages_left
+            HAVING count(*) > 1
+        ), merged AS (
+            UPDATE iteminstance i SET quantity = stacks.quantity
+            FROM stacks
+            WHERE i.id = stacks.id
+        )
+        DELETE FROM iteminstance i
+        USING stacks
+        WHERE i.owner_id = stacks.owner_id AND i.type_id = stacks.type_id
+          AND i.usages_left = stacks.usages_left AND i.id <> stacks.id
+    """)
+    db.execute_sql("CREATE UNIQUE INDEX IF NOT EXISTS iteminstance_owner_id_type_id_usages_left "
+                   "ON iteminstance (owner_id, type_id, usages_left)")
+
+
+@migration(7, "enable existing locations")
+def enable_locations(db):
+    # is_enabled was never checked before travel started to respect it
+    db.execute_sql("UPDATE location SET is_enabled = TRUE")
+
+
+@migration(8, "allow shopping and healing state transitions")
+def add_state_transitions(db):
+    # transitions are enforced now; these were used without being declared
+    db.execute_sql("""
+        INSERT INTO herostatetransition (from_state_id, to_state_id)
+        SELECT f.id, t.id
+        FROM herostate f, herostate t
+        WHERE (f.name, t.name) IN (VALUES ('IDLE', 'SHOPPING'), ('SHOPPING', 'IDLE'),
+                                          ('IDLE', 'HEALING'), ('HEALING', 'IDLE'))
+        ON CONFLICT DO NOTHING
+    """)
+
+
+@migration(9, "version hero inventories")
+def add_inventory_version(db):
+    db.execute_sql("ALTER TABLE hero ADD COLUMN IF NOT EXISTS inventory_version INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(10, "index the admin list sort orders")
+def index_admin_sorts(db):
+    # keyset pagination walks (column, id); hero.name is unique already
+    db.execute_sql("CREATE INDEX IF NOT EXISTS hero_gold_id ON hero (gold, id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS hero_xp_value_id ON hero (xp_value, id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS location_name_id ON location (name, id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS location_type_id ON location (type, id)")
+    # gateways are looked up by either end for the group graph
+    db.execute_sql("CREATE INDEX IF NOT EXISTS locationgateway_to_location_id ON locationgateway (to_location_id)")
+
+
+@migration(11, "lease outbox rows until they are sent")
+def add_action_lease(db):
+    db.execute_sql("ALTER TABLE action ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP")
+
+
+def current_version():
+    return SchemaVersion.select(fn.Max(SchemaVersion.version)).scalar() or 0
+
+
+def migrate():
+    SchemaVersion.create_table(fail_silently=True)
+    applied = 0
+    for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        with settings.DB.atomic():
+            settings.DB.execute_sql("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK,))
+            if version <= current_version():
+                continue
+            logger.info("applying migration %d: %s", version, description)
+            func(settings.DB)
+            SchemaVersion.create(version=version)
+            applied += 1
+    return applied
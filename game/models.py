@@ -1,9 +1,22 @@
 import datetime
+import os
 from enum import Enum, auto
 from peewee import *
 from playhouse.postgres_ext import BinaryJSONField
 from playhouse.fields import ManyToManyField, DeferredThroughModel
 from conf import settings
+from game import combat
+
+WORLD_FILE = os.path.join(os.path.dirname(__file__), "worlds", "first_town.json")
+
+
+class TrackedModel(Model):
+    # An UPDATE sets just the assigned columns, so a stale instance can't
+    # overwrite values changed elsewhere (e.g. gold updated atomically by the
+    # shop); a save with nothing assigned is a no-op.
+    class Meta:
+        database = settings.DB
+        only_save_dirty = True
 
 
 class LocationGroup(Model):
@@ -74,18 +87,25 @@ class LocationGateway(Model):
         )
 
 
-class Activity(Model):
+class Activity(TrackedModel):
     RESPAWN = 0
     HEALING = 1
 
     TYPES = (
         (RESPAWN, "RESPAWN"),
-        (RESPAWN, "HEALING"),
+        (HEALING, "HEALING"),
     )
 
     type = SmallIntegerField(choices=TYPES)
     start_time = DateTimeField(default=datetime.datetime.now)
     duration = IntegerField(default=0)
+    due_time = DateTimeField(null=True, index=True)
+
+    @classmethod
+    def begin(cls, type, duration):
+        now = datetime.datetime.now()
+        return cls.create(type=type, start_time=now, duration=duration,
+                          due_time=now + datetime.timedelta(seconds=duration))
 
     class Meta:
         database = settings.DB
@@ -119,7 +139,7 @@ class Mob(Model):
         database = settings.DB
 
 
-class MobInstance(Model):
+class MobInstance(TrackedModel):
     type = ForeignKeyField(Mob)
     hp_value = IntegerField(constraints=[Check("hp_value > 0")])
 
@@ -127,7 +147,7 @@ class MobInstance(Model):
         database = settings.DB
 
 
-class Hero(Model):
+class Hero(TrackedModel):
     name = CharField(unique=True)
     state = ForeignKeyField(HeroState)
     activity = ForeignKeyField(Activity, null=True)
@@ -137,9 +157,11 @@ class Hero(Model):
     hp_base = IntegerField(default=100)
     hp_value = IntegerField(default=100)
     attacked_by = ForeignKeyField(MobInstance, null=True)
+    # bumped whenever the inventory changes, cached views key on it
+    inventory_version = IntegerField(default=0)
     last_update = DateTimeField(default=datetime.datetime.now)
 
-    chat_id = IntegerField()
+    chat_id = BigIntegerField(unique=True)
     registration_time = DateTimeField(default=datetime.datetime.now)
     last_message_at = DateTimeField(null=True)
 
@@ -149,10 +171,10 @@ class Hero(Model):
 
     @property
     def respawn_time(self):
-        return 5 + 5 * self.level
+        return combat.respawn_time(self.level)
 
     def get_full_recover_time(self):
-        return 15 * (self.hp_base - self.hp_value) / 5
+        return combat.recover_time(self.hp_base - self.hp_value)
 
     class Meta:
         database = settings.DB
@@ -203,14 +225,20 @@ class MobDrops(Model):
         database = settings.DB
 
 
-class ItemInstance(Model):
+# One row is a stack of identical items: same owner, type and usages left.
+class ItemInstance(TrackedModel):
     type = ForeignKeyField(Item)
     owner = ForeignKeyField(Hero, related_name="items")
     usages_left = IntegerField(constraints=[Check("usages_left > 0")])
         #Check("usages_left <= prototype.usages")])
+    quantity = IntegerField(default=1, constraints=[Check("quantity > 0")])
 
     class Meta:
         database = settings.DB
+        indexes = (
+            (("owner", "type"), False),
+            (("owner", "type", "usages_left"), True),
+        )
 
 
 class ShopSlot(Model):
@@ -224,6 +252,30 @@ class ShopSlot(Model):
         primary_key = CompositeKey("location", "item")
 
 
+class WorldVersion(Model):
+    version = IntegerField(default=0)
+
+    class Meta:
+        database = settings.DB
+
+    @classmethod
+    def current(cls):
+        return cls.select(cls.version).scalar() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.update(version=cls.version + 1).execute():
+            cls.create(version=1)
+
+
+class SchemaVersion(Model):
+    version = IntegerField(unique=True)
+    applied_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        database = settings.DB
+
+
 class Action(Model):
     MONEY = 0
     LOOT = 1
@@ -236,7 +288,15 @@ class Action(Model):
     )
     receiver = ForeignKeyField(Hero)
     message = TextField()
+    markup = TextField(null=True)
     is_notified = BooleanField(default=False)
+    claimed_until = DateTimeField(null=True)
+
+    @classmethod
+    def notify(cls, hero, message, markup=None):
+        # call inside the transaction that changes the hero, so the message
+        # exists if and only if the change was committed
+        return cls.create(receiver=hero, message=message, markup=markup)
 
     class Meta:
         database = settings.DB
@@ -259,45 +319,20 @@ def create_db():
         ShopSlot.create_table()
         MobDwells.create_table()
         MobDrops.create_table()
+        WorldVersion.create_table()
 
 def create_hero_actions():
     with settings.DB.atomic():
         idle = HeroState.create(name="IDLE")
         travel = HeroState.create(name="TRAVEL")
         fight = HeroState.create(name="FIGHT")
-        HeroState.create(name="SHOPPING")
-        HeroState.create(name="HEALING")
-        HeroStateTransition.create(from_state=idle, to_state=travel)
-        HeroStateTransition.create(to_state=idle, from_state=travel)
-        HeroStateTransition.create(from_state=idle, to_state=fight)
-        HeroStateTransition.create(to_state=idle, from_state=fight)
+        shopping = HeroState.create(name="SHOPPING")
+        healing = HeroState.create(name="HEALING")
+        for state in (travel, fight, shopping, healing):
+            HeroStateTransition.create(from_state=idle, to_state=state)
+            HeroStateTransition.create(from_state=state, to_state=idle)
 
 def create_world():
-    with settings.DB.atomic():
-        group = LocationGroup.create(name="The First Town", type=LocationGroup.TOWN, description="Every player starts here")
-        first_city = Location.create(type=Location.START, name="Main Area",
-                        description="Every adventure starts there.", group=group)
-        cave = Location.create(type=Location.FIGHT, name="Goblin's Cave",
-                        description="Small creatures lurk within.", group=group)
-        shop = Location.create(type=Location.SHOP, name="Market",
-                        description="A lot of people here...", group=group)
-        tavern = Location.create(type=Location.HEALING, name="Tavern",
-                        description="You can heal here", group=group)
-        first_city.link_with(cave)
-        first_city.link_with(shop)
-        first_city.link_with(tavern)
-
-        minotaur = Mob.create(name="Minotaur", damage=10, critical=30, critical_chance=0.3, hp_base=20)
-
-        plain_sword = Item.create(type=Item.DAMAGE, title='Plain Sword',
-                            value=30, usages=100, price=50)
-        plain_shield = Item.create(type=Item.GUARD, title='Plain Shield',
-                            value=20, usages=100, price=50)
-
-        MobDrops.create(mob=minotaur, item=plain_sword, chance=0.7)
-        MobDrops.create(mob=minotaur, item=plain_shield, chance=0.7)
-
-        MobDwells.create(mob=minotaur, location=cave, chance=1)
-
-        ShopSlot.create(location=shop, item=plain_shield, count=5, price=50)
-        ShopSlot.create(location=shop, item=plain_sword, count=5, price=50)
+    # the starting world ships as a world file, see game/worldfile.py
+    from game import worldfile
+    worldfile.import_world(worldfile.load(WORLD_FILE))
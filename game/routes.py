@@ -0,0 +1,70 @@
+import heapq
+import threading
+from collections import OrderedDict
+
+
+def passable(gateway, blocked=frozenset()):
+    return gateway.to_location.is_enabled and gateway.id not in blocked
+
+
+# Shortest paths over one world snapshot. Cost of a path is the sum of the
+# enter prices of the locations it enters, ties are broken by hop count.
+# Trees are computed on demand per source and kept, least recently used
+# first out, up to `size` of them; a new world version gets a fresh index.
+# Gateways whose conditions a hero fails are passed in as `blocked`; heroes
+# failing the same ones share trees.
+class RouteIndex:
+    def __init__(self, locations, exits, size=4096):
+        self.locations = locations
+        self.exits = exits
+        self.size = size
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+
+    def tree(self, source_id, blocked=frozenset()):
+        key = (source_id, blocked)
+        with self._lock:
+            tree = self._trees.get(key)
+            if tree is not None:
+                self._trees.move_to_end(key)
+                return tree
+        tree = self._search(source_id, blocked)
+        with self._lock:
+            self._trees[key] = tree
+            if len(self._trees) > self.size:
+                self._trees.popitem(last=False)
+        return tree
+
+    def _search(self, source_id, blocked):
+        # location id -> (cost, hops, gateway used to enter it)
+        tree = {source_id: (0, 0, None)}
+        queue = [(0, 0, source_id)]
+        while queue:
+            cost, hops, location_id = heapq.heappop(queue)
+            if (cost, hops) > tree[location_id][:2]:
+                continue
+            for gateway in self.exits.get(location_id, []):
+                if not passable(gateway, blocked):
+                    continue
+                target = gateway.to_location_id
+                step = (cost + gateway.to_location.enter_price, hops + 1)
+                known = tree.get(target)
+                if known is None or step < known[:2]:
+                    tree[target] = step + (gateway,)
+                    heapq.heappush(queue, step + (target,))
+        return tree
+
+    def route(self, source_id, target_id, blocked=frozenset()):
+        # returns (cost, [gateway, ...]) or None when unreachable
+        tree = self.tree(source_id, blocked)
+        if target_id not in tree:
+            return None
+        cost = tree[target_id][0]
+        path = []
+        location_id = target_id
+        while location_id != source_id:
+            gateway = tree[location_id][2]
+            path.append(gateway)
+            location_id = gateway.from_location_id
+        path.reverse()
+        return cost, path
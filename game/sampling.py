@@ -0,0 +1,46 @@
+import random
+
+
+# Walker's alias method (Vose's construction): O(n) to build, O(1) per
+# draw. Weights need not sum to 1; they are normalized here.
+class AliasTable:
+    def __init__(self, outcomes, weights):
+        if not outcomes:
+            raise ValueError("no outcomes to sample from")
+        total = float(sum(weights))
+        if total <= 0:
+            raise ValueError("weights must sum to a positive number")
+        n = len(outcomes)
+        self.outcomes = list(outcomes)
+        self.prob = [0.0] * n
+        self.alias = list(range(n))
+
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def __len__(self):
+        return len(self.outcomes)
+
+    def sample(self, rng=random):
+        i = rng.randrange(len(self.outcomes))
+        if rng.random() < self.prob[i]:
+            return self.outcomes[i]
+        return self.outcomes[self.alias[i]]
+
+
+# Independent drops: each (item, chance) is rolled on its own, as before.
+class DropTable:
+    def __init__(self, drops):
+        self.drops = [(drop.item, drop.chance) for drop in drops]
+
+    def roll(self, rng=random):
+        return [item for item, chance in self.drops if rng.random() < chance]
@@ -0,0 +1,121 @@
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from peewee import fn
+from game.models import Hero, Activity
+
+logger = logging.getLogger(__name__)
+
+
+# A single timer thread over a heap of (due, seq, kind, key) entries:
+# scheduling is O(log n), pending timers cost one tuple each, and due
+# callbacks run on a small worker pool so a slow one can't hold the clock.
+# Timers are never cancelled; callbacks must check that they still apply.
+class Scheduler:
+    def __init__(self, workers=4, batch_size=500):
+        self.batch_size = batch_size
+        self._workers = workers
+        self._heap = []
+        self._seq = itertools.count()
+        self._callbacks = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+        self._running = False
+        self._context = None
+
+    def register(self, kind, callback):
+        self._callbacks[kind] = callback
+
+    def schedule(self, kind, due, key):
+        with self._cond:
+            seq = next(self._seq)
+            heapq.heappush(self._heap, (due, seq, kind, key))
+            # only a new earliest timer changes how long the clock sleeps
+            if self._heap[0][1] == seq:
+                self._cond.notify()
+
+    def schedule_in(self, kind, seconds, key):
+        self.schedule(kind, datetime.datetime.now() + datetime.timedelta(seconds=seconds), key)
+
+    def schedule_many(self, entries):
+        with self._cond:
+            for due, kind, key in entries:
+                self._heap.append((due, next(self._seq), kind, key))
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self, context):
+        self._context = context
+        self._running = True
+        self._pool = ThreadPoolExecutor(self._workers)
+        self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._pool.shutdown()
+
+    def _next_batch(self):
+        with self._cond:
+            while self._running:
+                now = datetime.datetime.now()
+                if self._heap and self._heap[0][0] <= now:
+                    batch = []
+                    while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                        batch.append(heapq.heappop(self._heap))
+                    return batch
+                timeout = (self._heap[0][0] - now).total_seconds() if self._heap else None
+                self._cond.wait(timeout)
+            return None
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            for _, _, kind, key in batch:
+                self._pool.submit(self._fire, kind, key)
+
+    def _fire(self, kind, key):
+        try:
+            self._callbacks[kind](self._context, key)
+        except Exception:
+            logger.exception("timer %s(%s) failed", kind, key)
+
+
+def pending_activities(shard=0, shards=1, after=None):
+    # (hero id, activity type, due time) for every hero waiting on an
+    # activity, soonest first; relies on the activity.due_time index.
+    # `after` limits it to activities created since that activity id.
+    query = (Hero
+             .select(Hero.id, Activity.type, Activity.due_time)
+             .join(Activity)
+             .where(Activity.due_time.is_null(False))
+             .order_by(Activity.due_time))
+    if after is not None:
+        query = query.where(Activity.id > after)
+    if shards > 1:
+        query = query.where(of_shard(shard, shards))
+    return query.tuples()
+
+
+def last_activity():
+    # watermark for pending_activities(after=...)
+    return Activity.select(fn.Max(Activity.id)).scalar() or 0
+
+
+def of_shard(shard, shards):
+    # heroes whose updates are handled by webhook worker `shard`; same as
+    # the webhook's `chat_id % shards`, also for negative chat ids
+    return fn.MOD(fn.MOD(Hero.chat_id, shards) + shards, shards) == shard
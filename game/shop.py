@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import namedtuple
+from conf import settings
+from game.models import ShopSlot
+
+# Shop trades, each a single statement in its own transaction. The hero row
+# is locked first, so concurrent trades of one hero serialize and gold is
+# checked against its current value; the slot update re-checks the stock
+# after waiting for concurrent buyers.
+
+OK = 0
+OUT_OF_STOCK = 1
+NO_MONEY = 2
+NOTHING_TO_SELL = 3
+
+# count: items traded; price: per item; gold: hero's gold after the trade;
+# inventory_version: the hero's after the trade
+Trade = namedtuple("Trade", ["status", "count", "price", "gold", "inventory_version"])
+
+BUY_SQL = """
+WITH buyer AS (
+    SELECT id, gold FROM hero WHERE id = %(hero)s FOR UPDATE
+), slot AS (
+    UPDATE shopslot s SET count = s.count - %(count)s
+    FROM buyer
+    WHERE s.location_id = %(location)s AND s.item_id = %(item)s
+      AND s.count >= %(count)s AND buyer.gold >= s.price * %(count)s
+    RETURNING s.price
+), debit AS (
+    UPDATE hero h SET gold = h.gold - slot.price * %(count)s, inventory_version = h.inventory_version + 1
+    FROM slot
+    WHERE h.id = %(hero)s
+    RETURNING h.gold, h.inventory_version
+), bought AS (
+    INSERT INTO iteminstance (type_id, owner_id, usages_left, quantity)
+    SELECT i.id, %(hero)s, i.usages, %(count)s
+    FROM item i, debit
+    WHERE i.id = %(item)s
+    ON CONFLICT (owner_id, type_id, usages_left)
+    DO UPDATE SET quantity = iteminstance.quantity + EXCLUDED.quantity
+)
+SELECT (SELECT price FROM slot), (SELECT gold FROM debit), (SELECT inventory_version FROM debit),
+       (SELECT gold FROM buyer), s.price, s.count
+FROM (SELECT 1) AS one
+LEFT JOIN shopslot s ON s.location_id = %(location)s AND s.item_id = %(item)s
+"""
+
+# Units are taken from the most durable stacks first; a NULL count sells
+# every unit. Stacks changed concurrently are left alone rather than
+# oversold: the DELETE/UPDATE conditions are re-checked on the live rows.
+SELL_SQL = """
+WITH seller AS (
+    SELECT id FROM hero WHERE id = %(hero)s FOR UPDATE
+), stacks AS (
+    SELECT ii.id, ii.quantity,
+           sum(ii.quantity) OVER (ORDER BY ii.usages_left DESC, ii.id) - ii.quantity AS before
+    FROM iteminstance ii, seller
+    WHERE ii.owner_id = seller.id AND ii.type_id = %(item)s
+), taken AS (
+    SELECT id, quantity,
+           CASE WHEN %(count)s IS NULL THEN quantity
+                ELSE LEAST(quantity, %(count)s - before) END AS take
+    FROM stacks
+    WHERE %(count)s IS NULL OR before < %(count)s
+), emptied AS (
+    DELETE FROM iteminstance ii USING taken
+    WHERE ii.id = taken.id AND ii.quantity = taken.take
+    RETURNING taken.take
+), reduced AS (
+    UPDATE iteminstance ii SET quantity = ii.quantity - taken.take
+    FROM taken
+    WHERE ii.id = taken.id AND ii.quantity > taken.take
+    RETURNING taken.take
+), sold AS (
+    SELECT take FROM emptied UNION ALL SELECT take FROM reduced
+), total AS (
+    SELECT sum(sold.take)::integer AS count, i.price
+    FROM sold, item i
+    WHERE i.id = %(item)s
+    GROUP BY i.price
+), restock AS (
+    INSERT INTO shopslot (location_id, item_id, count, price)
+    SELECT %(location)s, %(item)s, total.count, total.price FROM total
+    ON CONFLICT (location_id, item_id) DO UPDATE SET count = shopslot.count + EXCLUDED.count
+), credit AS (
+    UPDATE hero h SET gold = h.gold + total.count * total.price, inventory_version = h.inventory_version + 1
+    FROM total
+    WHERE h.id = %(hero)s
+    RETURNING h.gold, h.inventory_version
+)
+SELECT (SELECT count FROM total), (SELECT price FROM total), (SELECT gold FROM credit),
+       (SELECT inventory_version FROM credit)
+"""
+
+
+def buy(hero_id, location_id, item_id, count=1):
+    params = {"hero": hero_id, "location": location_id, "item": item_id, "count": count}
+    with settings.DB.atomic():
+        paid, gold, version, gold_before, price, stock = settings.DB.execute_sql(BUY_SQL, params).fetchone()
+    if paid is not None:
+        if stock == count:
+            stock_view.forget(location_id)
+        return Trade(OK, count, paid, gold, version)
+    if stock is None or stock < count:
+        return Trade(OUT_OF_STOCK, 0, price, gold_before, None)
+    return Trade(NO_MONEY, 0, price, gold_before, None)
+
+
+def sell(hero_id, location_id, item_id, count=1):
+    # count=None sells all of them
+    params = {"hero": hero_id, "location": location_id, "item": item_id, "count": count}
+    with settings.DB.atomic():
+        sold, price, gold, version = settings.DB.execute_sql(SELL_SQL, params).fetchone()
+    if not sold:
+        return Trade(NOTHING_TO_SELL, 0, None, None, None)
+    stock_view.forget(location_id)
+    return Trade(OK, sold, price, gold, version)
+
+
+def parse_order(text, allow_all=False):
+    # "'Title'", "3 'Title'" or, when selling, "all 'Title'"; count None
+    # means all of them. Returns None if it doesn't parse.
+    count = 1
+    if not text.startswith("'"):
+        amount, _, text = text.partition(" ")
+        if allow_all and amount.lower() == "all":
+            count = None
+        elif amount.isdigit() and int(amount) > 0:
+            count = int(amount)
+        else:
+            return None
+    if len(text) < 2 or not text.startswith("'") or not text.endswith("'"):
+        return None
+    return count, text[1:-1]
+
+
+# Items a shop has in stock, for its buy buttons. Stock moves with every
+# trade in any process, so it is re-read at most every `ttl` seconds and
+# dropped at once when a trade here may have emptied or refilled a slot.
+class StockView:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._stock = {}
+        self._lock = threading.Lock()
+
+    def in_stock(self, location_id):
+        now = time.monotonic()
+        entry = self._stock.get(location_id)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+        items = tuple(item_id for item_id, in ShopSlot
+                      .select(ShopSlot.item)
+                      .where((ShopSlot.location == location_id) & (ShopSlot.count > 0))
+                      .order_by(ShopSlot.item)
+                      .tuples())
+        with self._lock:
+            self._stock[location_id] = (now, items)
+        return items
+
+    def forget(self, location_id):
+        with self._lock:
+            self._stock.pop(location_id, None)
+
+
+stock_view = StockView(settings.STOCK_REFRESH_INTERVAL)
@@ -0,0 +1,87 @@
+from collections import namedtuple
+import numpy as np
+from game import combat
+
+# Vectorized Monte Carlo over the rules in game/combat.py: every array
+# element is one hero-vs-mob fight, all of them advanced a round at a time.
+# The hero always attacks, like a farming player does.
+
+FightStats = namedtuple("FightStats", [
+    "mob", "level", "fights", "win_rate", "hp_lost", "rounds_to_kill",
+    "seconds_per_fight", "kills_per_hour", "gold_per_hour", "xp_per_hour",
+])
+
+
+def simulate_fights(mob, level, fights, hp, rng, max_rounds=10000):
+    hero_hp = np.full(fights, hp, dtype=np.int64)
+    mob_hp = np.full(fights, mob.hp_base, dtype=np.int64)
+    rounds = np.zeros(fights, dtype=np.int64)
+    active = np.ones(fights, dtype=bool)
+    won = np.zeros(fights, dtype=bool)
+    hero_dmg = combat.hero_damage(level)
+
+    for _ in range(max_rounds):
+        if not active.any():
+            break
+        rounds += active
+        killed = active & (mob_hp - hero_dmg <= 0)
+        won |= killed
+        active &= ~killed
+        mob_hp -= np.where(active, hero_dmg, 0)
+
+        mob_dmg = np.where(rng.random(fights) < mob.critical_chance, mob.critical, mob.damage)
+        died = active & (hero_hp - mob_dmg <= 0)
+        active &= ~died
+        hero_hp = np.where(died, 0, hero_hp - np.where(active, mob_dmg, 0))
+    return won, hp - hero_hp, rounds
+
+
+def simulate(mob, level, fights, loot_value, hp=100, round_seconds=2.0, xp_per_kill=0,
+             batch=1000000, seed=None):
+    rng = np.random.default_rng(seed)
+    wins = hp_lost = rounds_won = seconds = 0.0
+    done = 0
+    while done < fights:
+        n = min(batch, fights - done)
+        won, lost, rounds = simulate_fights(mob, level, n, hp, rng)
+        wins += won.sum()
+        hp_lost += lost.sum()
+        rounds_won += rounds[won].sum()
+        # A won fight is followed by healing the lost HP and the next
+        # encounter; a lost one by respawning with full HP.
+        fight_time = rounds * round_seconds
+        after_win = combat.recover_time(lost) + combat.ENCOUNTER_DELAY
+        after_death = combat.respawn_time(level)
+        seconds += np.where(won, fight_time + after_win, fight_time + after_death).sum()
+        done += n
+
+    hours = seconds / 3600
+    kills_per_hour = wins / hours if hours else 0.0
+    return FightStats(
+        mob=mob.name,
+        level=level,
+        fights=fights,
+        win_rate=wins / fights,
+        hp_lost=hp_lost / fights,
+        rounds_to_kill=rounds_won / wins if wins else float("nan"),
+        seconds_per_fight=seconds / fights,
+        kills_per_hour=kills_per_hour,
+        gold_per_hour=kills_per_hour * loot_value,
+        xp_per_hour=kills_per_hour * xp_per_kill,
+    )
+
+
+def loot_value(drops):
+    # expected gold from selling a kill's drops back at the item price
+    return sum(drop.chance * drop.item.price for drop in drops)
+
+
+def format_table(rows):
+    header = ("mob", "lvl", "win%", "hp lost", "rounds", "s/fight", "kills/h", "gold/h", "xp/h")
+    lines = ["{:<16} {:>4} {:>7} {:>8} {:>7} {:>8} {:>8} {:>9} {:>8}".format(*header)]
+    for r in rows:
+        lines.append("{:<16} {:>4} {:>7.1%} {:>8.1f} {:>7.2f} {:>8.1f} {:>8.1f} {:>9.1f} {:>8.1f}".format(
+            r.mob[:16], r.level, r.win_rate, r.hp_lost, r.rounds_to_kill,
+            r.seconds_per_fight, r.kills_per_hour, r.gold_per_hour, r.xp_per_hour
+        ))
+    return "\n".join(lines)
@@ -0,0 +1,58 @@
+import threading
+from game.models import HeroState, HeroStateTransition
+
+
+# Hero states and transitions never change at runtime, so they are read once
+# and then served from memory: `states.IDLE`, `states.name_of(hero.state_id)`.
+class StateRegistry:
+    def __init__(self):
+        self._by_id = None
+        self._by_name = None
+        self._transitions = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            by_id = {state.id: state for state in HeroState.select()}
+            transitions = frozenset(
+                HeroStateTransition
+                .select(HeroStateTransition.from_state, HeroStateTransition.to_state)
+                .tuples()
+            )
+            self._by_name = {state.name: state for state in by_id.values()}
+            self._transitions = transitions
+            self._by_id = by_id
+
+    def _loaded(self):
+        if self._by_id is None:
+            self.load()
+        return self._by_id
+
+    def get(self, name):
+        self._loaded()
+        return self._by_name[name]
+
+    def by_id(self, state_id):
+        return self._loaded()[state_id]
+
+    def name_of(self, state_id):
+        return self._loaded()[state_id].name
+
+    def can_transition(self, from_state, to_state):
+        self._loaded()
+        return (_state_id(from_state), _state_id(to_state)) in self._transitions
+
+    def __getattr__(self, name):
+        if not name.isupper():
+            raise AttributeError(name)
+        try:
+            return self.get(name)
+        except KeyError:
+            raise AttributeError(name)
+
+
+def _state_id(state):
+    return state.id if isinstance(state, HeroState) else state
+
+
+states = StateRegistry()
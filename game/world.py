@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from conf import settings
+from game.models import Location, LocationGateway, Mob, Item, MobDwells, MobDrops, WorldVersion
+from game.sampling import AliasTable, DropTable
+from game.routes import RouteIndex, passable
+from game import conditions
+
+logger = logging.getLogger(__name__)
+
+
+class WorldSnapshot:
+    def __init__(self, version):
+        self.version = version
+        self.locations = {}
+        self.locations_by_name = {}
+        self.exits = {}
+        self.gated = []
+        self.mobs = {}
+        self.items = {}
+        self.items_by_title = {}
+        self.dwellings = {}
+        self.drops = {}
+        self.spawn_tables = {}
+        self.drop_tables = {}
+        self.routes = None
+
+    @classmethod
+    def load(cls, version):
+        world = cls(version)
+        for location in Location.select().order_by(Location.id):
+            world.locations[location.id] = location
+            world.locations_by_name.setdefault(location.name, location)
+            world.exits[location.id] = []
+        for gateway in LocationGateway.select().order_by(LocationGateway.id):
+            gateway.from_location = world.locations[gateway.from_location_id]
+            gateway.to_location = world.locations[gateway.to_location_id]
+            world.exits[gateway.from_location_id].append(gateway)
+            try:
+                gateway.check = conditions.compiled(gateway.condition)
+            except ValueError as e:
+                logger.warning("gateway %d has a bad condition: %s", gateway.id, e)
+                gateway.check = conditions.CLOSED
+            if gateway.check.checks:
+                world.gated.append(gateway)
+        world.routes = RouteIndex(world.locations, world.exits)
+
+        for mob in Mob.select().order_by(Mob.id):
+            world.mobs[mob.id] = mob
+            world.drops[mob.id] = []
+        for item in Item.select().order_by(Item.id):
+            world.items[item.id] = item
+            world.items_by_title.setdefault(item.title, item)
+
+        for dwell in MobDwells.select().order_by(MobDwells.id):
+            dwell.location = world.locations[dwell.location_id]
+            dwell.mob = world.mobs[dwell.mob_id]
+            world.dwellings.setdefault(dwell.location_id, []).append(dwell)
+        for drop in MobDrops.select().order_by(MobDrops.id):
+            drop.mob = world.mobs[drop.mob_id]
+            drop.item = world.items[drop.item_id]
+            world.drops[drop.mob_id].append(drop)
+
+        for location_id, dwellings in world.dwellings.items():
+            world.spawn_tables[location_id] = AliasTable(
+                [dwell.mob for dwell in dwellings],
+                [dwell.chance for dwell in dwellings]
+            )
+        for mob_id, drops in world.drops.items():
+            world.drop_tables[mob_id] = DropTable(drops)
+        return world
+
+
+# Snapshots are never mutated after load and are swapped atomically, so
+# readers don't take the lock. The admin bumps WorldVersion on every edit;
+# the cache notices it at most `refresh_interval` seconds later.
+class WorldCache:
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._snapshot = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - self._checked_at > self.refresh_interval:
+            snapshot = self.refresh()
+        return snapshot
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    def refresh(self, force=False):
+        with self._lock:
+            version = WorldVersion.current()
+            self._checked_at = time.monotonic()
+            if force or self._snapshot is None or self._snapshot.version != version:
+                self._snapshot = WorldSnapshot.load(version)
+            return self._snapshot
+
+    def load(self):
+        return self.refresh(force=True)
+
+    def invalidate(self):
+        WorldVersion.bump()
+        self._snapshot = None
+
+    def location(self, location_id):
+        return self.snapshot.locations[location_id]
+
+    def start_locations(self):
+        return [location for location in self.snapshot.locations.values()
+                if location.type == Location.START]
+
+    def location_by_name(self, name):
+        return self.snapshot.locations_by_name.get(name)
+
+    def exits(self, location_id):
+        return self.snapshot.exits.get(location_id, [])
+
+    def open_exits(self, location_id, hero):
+        exits = self.exits(location_id)
+        blocked = conditions.blocked(exits, hero)
+        return [gateway for gateway in exits if passable(gateway, blocked)]
+
+    def route(self, source_id, target_id, hero):
+        snapshot = self.snapshot
+        blocked = conditions.blocked(snapshot.gated, hero)
+        return snapshot.routes.route(source_id, target_id, blocked)
+
+    def mob(self, mob_id):
+        return self.snapshot.mobs[mob_id]
+
+    def item(self, item_id):
+        return self.snapshot.items[item_id]
+
+    def item_by_title(self, title):
+        return self.snapshot.items_by_title.get(title)
+
+    def drops(self, mob_id):
+        return self.snapshot.drops.get(mob_id, [])
+
+    def spawn_table(self, location_id):
+        return self.snapshot.spawn_tables.get(location_id)
+
+    def drop_table(self, mob_id):
+        return self.snapshot.drop_tables[mob_id]
+
+
+world = WorldCache(settings.WORLD_REFRESH_INTERVAL)
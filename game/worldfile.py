@@ -0,0 +1,210 @@
+import json
+import logging
+from collections import namedtuple
+from peewee import SQL
+from conf import settings
+from game.models import LocationGroup, Location, LocationGateway, Item, Mob, MobDrops, MobDwells, ShopSlot
+from game.models import WorldVersion
+
+logger = logging.getLogger(__name__)
+
+# World files describe the static world, one list per table:
+#
+#   {"format": 1,
+#    "groups": [{"id": 1, "type": "TOWN", "name": ..., "description": ...}],
+#    "locations": [{"id": 1, "type": "START", "name": ..., "group": 1, ...}],
+#    "gateways": [{"from_location": 1, "to_location": 2, "condition": {}}],
+#    "items": [...], "mobs": [...], "drops": [...], "dwellings": [...],
+#    "shop_slots": [...]}
+#
+# Rows of the id'd tables keep their ids, so references between sections
+# are plain ids; the other tables are matched by their natural keys.
+# Missing fields take the model defaults. YAML works if PyYAML is installed.
+
+FORMAT = 1
+BATCH_SIZE = 1000
+
+# `live` fields are only written when a row is created: the game changes
+# them afterwards (shop stock), so re-importing must not reset them. Rows
+# of sections that aren't `prunable` may be created by the game itself
+# (selling an item to a shop opens a slot) and are never pruned.
+Section = namedtuple("Section", ["name", "model", "key", "fields", "enums", "live", "prunable"],
+                     defaults=((), True))
+
+# in dependency order: inserts go top down, deletes bottom up
+SECTIONS = (
+    Section("groups", LocationGroup, ("id",), ("type", "name", "description"),
+            {"type": LocationGroup.TYPES}),
+    Section("locations", Location, ("id",),
+            ("type", "name", "description", "group", "is_enabled", "enter_price"),
+            {"type": Location.TYPES}),
+    Section("gateways", LocationGateway, ("from_location", "to_location"), ("condition",), {}),
+    Section("items", Item, ("id",), ("type", "title", "value", "usages", "price"), {"type": Item.TYPES}),
+    Section("mobs", Mob, ("id",), ("name", "hp_base", "damage", "critical", "critical_chance"), {}),
+    Section("drops", MobDrops, ("mob", "item"), ("chance",), {}),
+    Section("dwellings", MobDwells, ("mob", "location"), ("chance",), {}),
+    Section("shop_slots", ShopSlot, ("location", "item"), ("price",), {}, live=("count",), prunable=False),
+)
+
+Diff = namedtuple("Diff", ["section", "inserts", "updates", "deletes"])
+
+
+class WorldFileError(Exception):
+    pass
+
+
+def load(path):
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise WorldFileError("reading YAML world files needs PyYAML")
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+    if not isinstance(data, dict) or data.get("format") != FORMAT:
+        raise WorldFileError(f"not a format {FORMAT} world file")
+    return data
+
+
+def dump(data, path):
+    with open(path, "w") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            yaml.safe_dump(data, f, sort_keys=False, allow_unicode=True)
+        else:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+
+
+def _defaults(section):
+    defaults = {}
+    for name in section.fields + section.live:
+        field = section.model._meta.fields[name]
+        if field.default is not None:
+            defaults[name] = field.default() if callable(field.default) else field.default
+        elif field.null:
+            defaults[name] = None
+    return defaults
+
+
+def _normalize(section, row):
+    # file row -> column values as stored
+    known = set(section.key) | set(section.fields) | set(section.live)
+    unknown = set(row) - known
+    if unknown:
+        raise WorldFileError(f"{section.name}: unknown fields {', '.join(sorted(unknown))} in {row}")
+    values = dict(_defaults(section), **row)
+    missing = known - set(values)
+    if missing:
+        raise WorldFileError(f"{section.name}: missing {', '.join(sorted(missing))} in {row}")
+    for name, choices in section.enums.items():
+        if isinstance(values[name], str):
+            by_name = {label: value for value, label in choices}
+            if values[name] not in by_name:
+                raise WorldFileError(f"{section.name}: unknown {name} {values[name]!r}")
+            values[name] = by_name[values[name]]
+    return values
+
+
+def _key(section, values):
+    return tuple(values[name] for name in section.key)
+
+
+def _existing(section):
+    model = section.model
+    columns = [model._meta.fields[name] for name in section.key + section.fields]
+    rows = {}
+    for values in model.select(*columns).dicts():
+        rows[_key(section, values)] = values
+    return rows
+
+
+def diff(data, prune=False):
+    diffs = []
+    for section in SECTIONS:
+        wanted = {}
+        for row in data.get(section.name, []):
+            values = _normalize(section, row)
+            key = _key(section, values)
+            if key in wanted:
+                raise WorldFileError(f"{section.name}: duplicate {dict(zip(section.key, key))}")
+            wanted[key] = values
+        existing = _existing(section)
+        inserts = [values for key, values in wanted.items() if key not in existing]
+        updates = [values for key, values in wanted.items()
+                   if key in existing and any(existing[key][name] != values[name] for name in section.fields)]
+        deletes = [key for key in existing if key not in wanted] if prune and section.prunable else []
+        diffs.append(Diff(section, inserts, updates, deletes))
+    return diffs
+
+
+def _batches(rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        yield rows[start:start + BATCH_SIZE]
+
+
+def _matching(section, keys):
+    # IN lists rather than a chain of ORs, which peewee compiles recursively
+    model = section.model
+    if section.key == ("id",):
+        return model.id << [key[0] for key in keys]
+    columns = ", ".join(model._meta.fields[name].db_column for name in section.key)
+    rows = ", ".join(["(" + ", ".join(["%s"] * len(section.key)) + ")"] * len(keys))
+    return SQL(f"({columns}) IN (VALUES {rows})", *[value for key in keys for value in key])
+
+
+def apply(diffs):
+    # One short transaction per batch rather than one for the whole file,
+    # so a large import doesn't hold locks for minutes.
+    for change in diffs:
+        section, model = change.section, change.section.model
+        for batch in _batches(change.inserts):
+            with settings.DB.atomic():
+                model.insert_many(batch).execute()
+        for batch in _batches(change.updates):
+            with settings.DB.atomic():
+                for values in batch:
+                    model.update(**{name: values[name] for name in section.fields}).where(
+                        _matching(section, [_key(section, values)])
+                    ).execute()
+        if "id" in section.key and change.inserts:
+            # rows came with their ids, move the sequence past them
+            table = model._meta.db_table
+            settings.DB.execute_sql(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)"
+            )
+    for change in reversed(diffs):
+        for batch in _batches(change.deletes):
+            with settings.DB.atomic():
+                change.section.model.delete().where(_matching(change.section, batch)).execute()
+    if any(change.inserts or change.updates or change.deletes for change in diffs):
+        WorldVersion.bump()
+
+
+def import_world(data, prune=False, dry_run=False):
+    diffs = diff(data, prune)
+    if not dry_run:
+        apply(diffs)
+    return diffs
+
+
+def export_world():
+    data = {"format": FORMAT}
+    for section in SECTIONS:
+        rows = []
+        order = [section.model._meta.fields[name] for name in section.key]
+        for values in section.model.select().order_by(*order).dicts():
+            row = {name: values[name] for name in section.key + section.fields + section.live}
+            for name, choices in section.enums.items():
+                row[name] = dict(choices)[row[name]]
+            rows.append(row)
+        data[section.name] = rows
+    return data
+
+
+def format_diff(diffs):
+    return "\n".join(f"{change.section.name:<12}+{len(change.inserts):<8}~{len(change.updates):<8}"
+                     f"-{len(change.deletes)}" for change in diffs)
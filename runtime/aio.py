@@ -0,0 +1,82 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import NetworkError, TimedOut
+from conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Updates are routed to one queue per chat and each queue is drained by its
+# own coroutine, so a chat's updates are handled strictly in order while
+# different chats proceed concurrently. The handlers themselves are the
+# synchronous peewee/telegram ones and run on a thread pool that is kept
+# smaller than the DB connection pool.
+class AsyncRuntime:
+    def __init__(self, bot, dispatcher, workers, poll_timeout=10, chat_idle_timeout=60):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.poll_timeout = poll_timeout
+        self.chat_idle_timeout = chat_idle_timeout
+        self._chats = {}
+        self._offset = None
+        self._slots = None
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="handler")
+        self._io = ThreadPoolExecutor(1, thread_name_prefix="poll")
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self._slots = asyncio.Semaphore(self.workers)
+        await self._run_in(self._io, self.bot.delete_webhook)
+        while True:
+            try:
+                updates = await self._run_in(self._io, functools.partial(
+                    self.bot.get_updates, offset=self._offset, timeout=self.poll_timeout
+                ))
+            except TimedOut:
+                continue
+            except NetworkError:
+                logger.exception("getUpdates failed")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self._offset = update.update_id + 1
+                self.feed(update)
+
+    def feed(self, update):
+        chat = update.effective_chat
+        chat_id = chat.id if chat is not None else None
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = asyncio.Queue()
+            asyncio.ensure_future(self._drain(chat_id, queue))
+        queue.put_nowait(update)
+
+    async def _drain(self, chat_id, queue):
+        while True:
+            try:
+                update = await asyncio.wait_for(queue.get(), self.chat_idle_timeout)
+            except asyncio.TimeoutError:
+                # nothing can be queued between this check and the removal:
+                # both run on the event loop without yielding
+                if queue.empty():
+                    del self._chats[chat_id]
+                    return
+                continue
+            async with self._slots:
+                await self._run_in(self._pool, self._process, update)
+
+    def _process(self, update):
+        try:
+            self.dispatcher.process_update(update)
+        finally:
+            # hand the connection back to the pool between updates
+            if not settings.DB.is_closed():
+                settings.DB.close()
+
+    def _run_in(self, executor, func, *args):
+        return asyncio.get_event_loop().run_in_executor(executor, func, *args)
@@ -0,0 +1,138 @@
+import argparse
+import itertools
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+# Just enough of the Bot API (getMe, getUpdates, sendMessage, ...) to run
+# the bot without network access. Point TELEGRAM_API_URL at
+# http://<host>:<port>/bot and inject player messages with push_message()
+# or by POSTing {"chat_id": ..., "text": ...} to /fake/updates.
+class FakeTelegram:
+    def __init__(self, host="127.0.0.1", port=8081):
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self.listeners = []
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_message(self, chat_id, text):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"player{chat_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split(None, 1)[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return self.push_update({"message": message})
+
+    def push_update(self, update):
+        with self._cond:
+            update = dict(update, update_id=next(self._update_ids))
+            self._updates.append(update)
+            self._cond.notify_all()
+        return update["update_id"]
+
+    def get_updates(self, offset=None, timeout=0, limit=100):
+        deadline = time.monotonic() + (timeout or 0)
+        with self._cond:
+            if offset is not None:
+                self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._updates[:limit]
+
+    def send_message(self, params):
+        chat_id = int(params["chat_id"])
+        reply_markup = params.get("reply_markup")
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 0, "is_bot": True, "first_name": "0pg"},
+            "text": params.get("text", ""),
+        }
+        for listener in self.listeners:
+            listener(chat_id, message["text"], reply_markup)
+        return message
+
+    def call(self, method, params):
+        if method == "getMe":
+            return {"id": 0, "is_bot": True, "first_name": "0pg", "username": "zpg_bot"}
+        if method == "getUpdates":
+            return self.get_updates(params.get("offset"), float(params.get("timeout") or 0),
+                                    int(params.get("limit") or 100))
+        if method == "sendMessage":
+            return self.send_message(params)
+        # deleteWebhook, setWebhook, answerCallbackQuery, ...
+        return True
+
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            params = json.loads(body) if body else {}
+            if self.path == "/fake/updates":
+                result = fake.push_message(int(params["chat_id"]), params["text"])
+            else:
+                result = fake.call(self.path.rsplit("/", 1)[-1], params)
+            payload = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    fake = FakeTelegram(args.host, args.port)
+    fake.listeners.append(lambda chat_id, text, markup: logger.info("-> %s: %s %s", chat_id, text, markup or ""))
+    logger.info("serving on %s", fake.url)
+    fake.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import json
+import threading
+from collections import OrderedDict
+
+
+def markup(rows, one_time=True):
+    # serialized once; the Bot API takes reply_markup as a JSON string
+    return json.dumps({"keyboard": rows, "resize_keyboard": True, "one_time_keyboard": one_time})
+
+
+# Bounded LRU of values that are expensive to build. Keys carry everything
+# the value depends on (world version, location, inventory version, ...),
+# so a changed input is a new key and stale entries simply age out.
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+
+keyboards = LRUCache(4096)
+# item types per (hero id, inventory version), for the sell buttons
+inventories = LRUCache(16384)
@@ -0,0 +1,279 @@
+import functools
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+
+LOCK_WAITS_SQL = """
+SELECT count(*), coalesce(max(extract(epoch FROM now() - state_change)), 0)
+FROM pg_stat_activity
+WHERE wait_event_type = 'Lock' AND datname = current_database()
+"""
+
+
+SAMPLE = re.compile(r"([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (.*)")
+
+
+def merge(files):
+    # Textfiles of several processes as one exposition: every sample of a
+    # family together under a single HELP/TYPE, and each file's `labels`
+    # (e.g. its shard) added to its samples so equal label sets don't clash.
+    families = OrderedDict()
+    for labels, text in files:
+        for line in text.splitlines():
+            if line.startswith("# "):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], {"HELP": None, "TYPE": None, "samples": []})
+                    family[parts[1]] = family[parts[1]] or line
+                continue
+            match = SAMPLE.match(line)
+            if match is None:
+                continue
+            name, sample_labels, value = match.groups()
+            family = name
+            for suffix in ("_bucket", "_sum", "_count"):
+                if name.endswith(suffix) and name[:-len(suffix)] in families:
+                    family = name[:-len(suffix)]
+            # shard processes already label their own samples
+            extra = ",".join(f'{key}="{value}"' for key, value in sorted((labels or {}).items())
+                             if not re.search(rf'(^|,){key}="', sample_labels or ""))
+            if extra:
+                sample_labels = f"{extra},{sample_labels}" if sample_labels else extra
+            sample = f"{name}{{{sample_labels}}} {value}" if sample_labels else f"{name} {value}"
+            families.setdefault(family, {"HELP": None, "TYPE": None, "samples": []})["samples"].append(sample)
+    lines = []
+    for family in families.values():
+        lines.extend(line for line in (family["HELP"], family["TYPE"]) if line)
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = n
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0
+
+    def samples(self, name, labels):
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f"{name}_bucket", dict(labels, le=le), seen
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class Value:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._kinds = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, labels, help, factory):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, factory())
+                self._kinds.setdefault(name, (kind, help))
+        return metric
+
+    def histogram(self, name, help="", buckets=LATENCY_BUCKETS, **labels):
+        return self._get("histogram", name, labels, help, lambda: Histogram(buckets))
+
+    def counter(self, name, help="", **labels):
+        return self._get("counter", name, labels, help, Value)
+
+    def gauge(self, name, help="", **labels):
+        return self._get("gauge", name, labels, help, Value)
+
+    def render(self, extra_labels=None):
+        lines = []
+        described = set()
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda item: item[0]):
+            if name not in described:
+                kind, help = self._kinds[name]
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+            for sample, sample_labels, value in metric.samples(name, dict(labels, **(extra_labels or {}))):
+                if sample_labels:
+                    pairs = ",".join(f'{key}="{label}"' for key, label in sorted(sample_labels.items()))
+                    lines.append(f"{sample}{{{pairs}}} {value}")
+                else:
+                    lines.append(f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        lines = []
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda item: item[0]):
+            label = ",".join(f"{key}={label}" for key, label in labels)
+            title = f"{name}{{{label}}}" if label else name
+            if isinstance(metric, Histogram):
+                if metric.count:
+                    lines.append(f"{title} n={metric.count} avg={metric.sum / metric.count:.4g} "
+                                 f"p50<={metric.quantile(0.5)} p95<={metric.quantile(0.95)} "
+                                 f"p99<={metric.quantile(0.99)}")
+            else:
+                lines.append(f"{title} {metric.value}")
+        return "\n".join(lines)
+
+
+metrics = Registry()
+_update = threading.local()
+
+
+def timed(name, help=""):
+    # latency histogram of a handler, labelled with its function name
+    def decorator(func):
+        histogram = metrics.histogram(name, help, handler=func.__name__)
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.monotonic() - started)
+        return wrapped
+    return decorator
+
+
+def instrument_db(db):
+    queries = metrics.counter("zpg_db_queries_total", "Statements executed")
+    latency = metrics.histogram("zpg_db_query_seconds", "Statement execution time")
+    execute_sql = db.execute_sql
+
+    def measured_execute_sql(*args, **kwargs):
+        started = time.monotonic()
+        cursor = execute_sql(*args, **kwargs)
+        latency.observe(time.monotonic() - started)
+        queries.inc()
+        if getattr(_update, "queries", None) is not None:
+            _update.queries += 1
+            _update.rows += max(cursor.rowcount, 0)
+        return cursor
+
+    db.execute_sql = measured_execute_sql
+
+
+def instrument_dispatcher(dispatcher):
+    # every registered callback gets its own histogram; the update as a
+    # whole is measured along with the queries it issued
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = timed("zpg_handler_seconds", "Handler latency")(handler.callback)
+
+    latency = metrics.histogram("zpg_update_seconds", "Update processing time")
+    queries = metrics.histogram("zpg_update_queries", "Statements per update", buckets=COUNT_BUCKETS)
+    rows = metrics.histogram("zpg_update_rows", "Rows returned or changed per update", buckets=ROW_BUCKETS)
+    process_update = dispatcher.process_update
+
+    def measured_process_update(update):
+        _update.queries = _update.rows = 0
+        started = time.monotonic()
+        try:
+            return process_update(update)
+        finally:
+            latency.observe(time.monotonic() - started)
+            queries.observe(_update.queries)
+            rows.observe(_update.rows)
+            _update.queries = None
+
+    dispatcher.process_update = measured_process_update
+
+
+# Periodically samples lock waits, writes the registry to a textfile that
+# the admin serves on /metrics (the bot has no HTTP server of its own) and
+# logs a summary.
+class Reporter:
+    def __init__(self, db, path, interval, labels=None):
+        self.db = db
+        self.path = path
+        self.interval = interval
+        self.labels = labels
+        self._lock_waits = metrics.gauge("zpg_db_lock_waits", "Backends waiting for a lock")
+        self._lock_wait_age = metrics.gauge("zpg_db_lock_wait_seconds", "Longest current lock wait")
+        self._stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="metrics", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.report()
+            except Exception:
+                logger.exception("metrics report failed")
+
+    def report(self):
+        try:
+            waiting, age = self.db.execute_sql(LOCK_WAITS_SQL).fetchone()
+        finally:
+            if not self.db.is_closed():
+                self.db.close()
+        self._lock_waits.set(waiting)
+        self._lock_wait_age.set(float(age))
+        if self.path:
+            write_textfile(self.path, metrics.render(self.labels))
+        logger.info("metrics:\n%s", metrics.summary())
+
+
+def write_textfile(path, text):
+    # written aside and renamed, so readers never see half a file
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        f.write(text)
+    os.replace(temporary, path)
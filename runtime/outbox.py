@@ -0,0 +1,104 @@
+import datetime
+import functools
+import logging
+import threading
+from conf import settings
+from game.models import Action
+
+logger = logging.getLogger(__name__)
+
+# Rows claimed by another worker are skipped rather than waited for, so any
+# number of workers (in any number of processes) can drain the table. With
+# webhook shards each process only takes its own chats, keeping their order.
+# SQL mod() keeps the sign of negative (group) chat ids, the outer mod
+# makes it match the webhook's Python `chat_id % shards`. Within a process
+# each worker thread takes its own receivers, so a hero's messages are
+# always handed to the sender by one thread, in id order.
+CLAIM_SQL = """
+SELECT a.id, h.chat_id, a.message, a.markup
+FROM action a JOIN hero h ON h.id = a.receiver_id
+WHERE NOT a.is_notified AND (a.claimed_until IS NULL OR a.claimed_until < %(now)s)
+  AND mod(mod(h.chat_id, %(shards)s) + %(shards)s, %(shards)s) = %(shard)s
+  AND mod(a.receiver_id, %(workers)s) = %(worker)s
+ORDER BY a.id
+LIMIT %(limit)s
+FOR UPDATE OF a SKIP LOCKED
+"""
+
+
+# Drains the Action table into the outbound queue. Claimed rows are leased
+# for `lease` seconds and only marked notified once the sender is done with
+# them, so messages still queued when the process dies are claimed again
+# later (at least once rather than at most once). Messages Telegram refuses
+# or that fail max_retries times are marked notified too: they are logged
+# by the sender and not sent again.
+class ActionDelivery:
+    def __init__(self, outbound, workers=1, batch_size=500, interval=1.0, shard=0, shards=1, lease=300):
+        self.outbound = outbound
+        self.lease = lease
+        self.shard = shard
+        self.shards = shards
+        self.workers = workers
+        self.batch_size = batch_size
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._running = False
+        self._threads = []
+        self._sent = []
+        self._sent_lock = threading.Lock()
+
+    def deliver_batch(self, worker=0):
+        self.mark_sent()
+        now = datetime.datetime.now()
+        with settings.DB.atomic():
+            rows = settings.DB.execute_sql(CLAIM_SQL, {"shards": self.shards, "shard": self.shard, "now": now,
+                                                       "workers": self.workers, "worker": worker,
+                                                       "limit": self.batch_size}).fetchall()
+            if not rows:
+                return 0
+            claimed_until = now + datetime.timedelta(seconds=self.lease)
+            Action.update(claimed_until=claimed_until).where(Action.id << [row[0] for row in rows]).execute()
+        for action_id, chat_id, message, markup in rows:
+            self.outbound.send(chat_id, message, reply_markup=markup,
+                               on_done=functools.partial(self._on_done, action_id))
+        return len(rows)
+
+    def _on_done(self, action_id):
+        with self._sent_lock:
+            self._sent.append(action_id)
+
+    def mark_sent(self):
+        # batched, from the delivery thread; a crash before this only
+        # means those messages are sent once more after the lease
+        with self._sent_lock:
+            sent, self._sent = self._sent, []
+        if sent:
+            Action.update(is_notified=True).where(Action.id << sent).execute()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self):
+        self._running = True
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(n,), name=f"outbox-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self.mark_sent()
+
+    def _run(self, worker):
+        while self._running:
+            try:
+                delivered = self.deliver_batch(worker)
+            except Exception:
+                logger.exception("action delivery failed")
+                delivered = 0
+            if delivered < self.batch_size:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
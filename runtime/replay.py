@@ -0,0 +1,54 @@
+import argparse
+import json
+import logging
+import time
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+
+# Posts recorded updates (one JSON object per line, as written with
+# WEBHOOK_RECORD) to a webhook, e.g. a local `bot.py webhook`:
+#
+#   python -m runtime.replay updates.jsonl http://127.0.0.1:8443/updates --rate 200
+def replay(lines, url, rate=None, renumber=True):
+    sent = failed = 0
+    started = time.monotonic()
+    for n, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        update = json.loads(line)
+        if renumber:
+            # recordings may be concatenated, keep the ids unique
+            update["update_id"] = n + 1
+        request = urllib.request.Request(url, data=json.dumps(update).encode(),
+                                         headers={"Content-Type": "application/json"})
+        try:
+            urllib.request.urlopen(request).close()
+            sent += 1
+        except OSError as e:
+            logger.warning("update %s: %s", update.get("update_id"), e)
+            failed += 1
+        if rate:
+            delay = started + (sent + failed) / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    return sent, failed, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post recorded updates to a webhook")
+    parser.add_argument("file")
+    parser.add_argument("url")
+    parser.add_argument("--rate", type=float, help="updates per second, as fast as possible if omitted")
+    parser.add_argument("--keep-ids", action="store_true", help="send the recorded update ids")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(args.file) as f:
+        sent, failed, elapsed = replay(f, args.url, args.rate, renumber=not args.keep_ids)
+    print(f"sent {sent}, failed {failed} in {elapsed:.1f}s ({sent / elapsed if elapsed else 0:.1f}/s)")
+
+
+if __name__ == "__main__":
+    main()
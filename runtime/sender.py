@@ -0,0 +1,207 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from telegram.error import RetryAfter, TimedOut, NetworkError, TelegramError, BadRequest, Unauthorized, ChatMigrated
+from runtime.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+# retrying won't help; BadRequest is a NetworkError, so it is caught first
+REFUSED = (BadRequest, Unauthorized, ChatMigrated)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+# Handlers only append to a per-chat list; sender threads pick the chat
+# that may send soonest (heap of ready times), merge everything pending for
+# it into one message and send it. A chat is owned by at most one sender at
+# a time, which keeps its messages in order.
+class OutboundQueue:
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, workers=4, max_retries=5):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.bot = None
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self._pending = {}
+        self._not_before = {}
+        self._inflight = set()
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+        self._threads = []
+        self._send_time = metrics.histogram("zpg_send_seconds", "sendMessage call time")
+        self._send_errors = metrics.counter("zpg_send_errors_total", "Failed sendMessage calls")
+
+    def send(self, chat_id, text, reply_markup=None, on_done=None):
+        # on_done() is called from a sender thread once the queue is through
+        # with the text: sent, refused for good (blocked bot, bad request) or
+        # given up on after max_retries. Failures are logged, not retried.
+        with self._cond:
+            pending = self._pending.get(chat_id)
+            if pending is None:
+                pending = self._pending[chat_id] = []
+                if chat_id not in self._inflight:
+                    self._push(chat_id)
+            pending.append((text, reply_markup, 0, [on_done] if on_done else []))
+
+    def limit_global(self, rate):
+        # e.g. a share of the global limit when several processes send
+        with self._cond:
+            self._global = TokenBucket(rate, rate)
+
+    def start(self, bot):
+        self.bot = bot
+        self._running = True
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"sender-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def pending(self):
+        with self._cond:
+            return sum(len(messages) for messages in self._pending.values())
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _push(self, chat_id):
+        now = time.monotonic()
+        ready = max(self._bucket(chat_id).ready_at(now), self._not_before.get(chat_id, now))
+        heapq.heappush(self._heap, (ready, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                if self._heap:
+                    ready = max(self._heap[0][0], self._global.ready_at(now))
+                    if ready <= now:
+                        _, _, chat_id = heapq.heappop(self._heap)
+                        self._global.take(now)
+                        self._bucket(chat_id).take(now)
+                        try:
+                            message = self._coalesce(chat_id)
+                        except Exception:
+                            logger.exception("dropping messages to %s", chat_id)
+                            self._pending.pop(chat_id, None)
+                            continue
+                        self._inflight.add(chat_id)
+                        return chat_id, message
+                    self._cond.wait(ready - now)
+                else:
+                    self._cond.wait()
+            return None, None
+
+    def _coalesce(self, chat_id):
+        pending = self._pending.pop(chat_id)
+        texts, markup, retries, callbacks = [], None, 0, []
+        length = 0
+        while pending:
+            text, reply_markup, attempts, sent = pending[0]
+            if texts and length + len(text) + 1 > MAX_MESSAGE_LENGTH:
+                break
+            pending.pop(0)
+            texts.append(text)
+            length += len(text) + 1
+            markup = reply_markup if reply_markup is not None else markup
+            retries = max(retries, attempts)
+            callbacks.extend(sent)
+        if pending:
+            self._pending[chat_id] = pending
+        return "\n".join(texts), markup, retries, callbacks
+
+    def _done(self, chat_id, retry=None, delay=0):
+        with self._cond:
+            self._inflight.discard(chat_id)
+            if retry is not None:
+                self._pending.setdefault(chat_id, []).insert(0, retry)
+                self._not_before[chat_id] = time.monotonic() + delay
+            else:
+                self._not_before.pop(chat_id, None)
+            if chat_id in self._pending:
+                self._push(chat_id)
+
+    def _run(self):
+        while True:
+            chat_id, message = self._next()
+            if chat_id is None:
+                return
+            text, markup, attempts, callbacks = message
+            retry, delay = None, 0
+            started = time.monotonic()
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text, reply_markup=markup)
+            except RetryAfter as e:
+                self._send_errors.inc()
+                retry, delay = self._retry(chat_id, message, e.retry_after)
+            except REFUSED:
+                self._send_errors.inc()
+                logger.exception("dropping message to %s", chat_id)
+            except (TimedOut, NetworkError):
+                self._send_errors.inc()
+                retry, delay = self._retry(chat_id, message, min(2 ** attempts, 60))
+            except TelegramError:
+                self._send_errors.inc()
+                logger.exception("dropping message to %s", chat_id)
+            except Exception:
+                # never lose the thread, or the chat stays in flight for good
+                self._send_errors.inc()
+                logger.exception("sending to %s failed, dropping the message", chat_id)
+            finally:
+                self._send_time.observe(time.monotonic() - started)
+                self._done(chat_id, retry, delay)
+            if retry is None:
+                self._settle(callbacks)
+
+    def _retry(self, chat_id, message, delay):
+        text, markup, attempts, callbacks = message
+        if attempts >= self.max_retries:
+            logger.error("giving up on message to %s after %d attempts", chat_id, attempts)
+            return None, 0
+        logger.warning("sending to %s failed, retrying in %ss", chat_id, delay)
+        return (text, markup, attempts + 1, callbacks), delay
+
+    def _settle(self, callbacks):
+        for on_done in callbacks:
+            try:
+                on_done()
+            except Exception:
+                logger.exception("on_done callback failed")
@@ -0,0 +1,115 @@
+import json
+import logging
+import multiprocessing
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+UPDATE_KINDS = ("message", "edited_message", "callback_query", "channel_post", "edited_channel_post")
+
+
+def chat_of(update):
+    # chat id an update belongs to, None if it isn't a chat update
+    for kind in UPDATE_KINDS:
+        payload = update.get(kind)
+        if isinstance(payload, dict):
+            if kind == "callback_query":
+                payload = payload.get("message") or {}
+            chat = payload.get("chat")
+            if isinstance(chat, dict) and isinstance(chat.get("id"), int):
+                return chat["id"]
+    return None
+
+
+def validate(update):
+    # None for updates the bot doesn't handle (inline queries, polls, ...);
+    # they are acknowledged and dropped, or Telegram would keep resending them
+    if not isinstance(update, dict) or not isinstance(update.get("update_id"), int):
+        raise ValueError("not an update")
+    return chat_of(update)
+
+
+# Telegram POSTs updates to http://<host>:<port>/<secret>. The server only
+# validates them and puts them on the queue of shard chat_id % N; every
+# shard is consumed by one worker process, one update at a time, so a
+# chat's updates keep their order while chats spread over N cores.
+class WebhookServer:
+    def __init__(self, host, port, secret, shards, record=None, context=None):
+        # workers must not inherit the parent's DB connections, hence spawn
+        self.context = context or multiprocessing.get_context("spawn")
+        self.secret = secret
+        self.shards = shards
+        self.queues = [self.context.Queue() for _ in range(shards)]
+        self.record = record
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+
+    def accept(self, body):
+        update = json.loads(body)
+        chat_id = validate(update)
+        if chat_id is None:
+            logger.debug("dropped update %s without a chat", update["update_id"])
+            return
+        # one at a time, so the queues (and the recording) keep arrival order
+        with self._lock:
+            if self.record is not None:
+                self.record.write(json.dumps(update) + "\n")
+                self.record.flush()
+            self.queues[chat_id % self.shards].put(update)
+
+    def start_workers(self, target, *args):
+        # target(shard, shards, queue, *args) runs in each worker process
+        workers = []
+        for shard, shard_queue in enumerate(self.queues):
+            worker = self.context.Process(target=target, args=(shard, self.shards, shard_queue) + args,
+                                          name=f"shard-{shard}", daemon=True)
+            worker.start()
+            workers.append(worker)
+        return workers
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for shard_queue in self.queues:
+            shard_queue.put(None)
+
+
+def _make_handler(webhook):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.strip("/") != webhook.secret:
+                return self._answer(404)
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                webhook.accept(self.rfile.read(length))
+            except ValueError as e:
+                logger.warning("rejected update: %s", e)
+                return self._answer(400)
+            self._answer(200)
+
+        def _answer(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return Handler
+
+
+def consume(updates, handle):
+    # worker side: handle updates in arrival order until a None arrives
+    while True:
+        update = updates.get()
+        if update is None:
+            return
+        try:
+            handle(update)
+        except Exception:
+            logger.exception("update %s failed", update.get("update_id"))
@@ -0,0 +1,8 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# conf.py builds the (lazily connecting) database from these
+for name in ("DB_NAME", "DB_USER", "DB_PASSWORD", "DB_HOST", "SESSION_COOKIE_SECRET_KEY", "SECRET_KEY"):
+    os.environ.setdefault(name, "test")
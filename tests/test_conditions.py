@@ -0,0 +1,67 @@
+import datetime
+from types import SimpleNamespace
+import pytest
+from game import conditions
+
+NOON = datetime.datetime(2024, 1, 1, 12)
+MIDNIGHT = datetime.datetime(2024, 1, 1, 0)
+
+
+def hero(level=1, gold=0):
+    return SimpleNamespace(id=1, level=level, gold=gold)
+
+
+@pytest.mark.parametrize("condition", [
+    [1],
+    {"min_level": 1, "color": "red"},
+    {"min_gold": "100"},
+    {"item": 1.5},
+    {"hours": [22]},
+    {"hours": [22, 25]},
+    {"hours": "22-4"},
+])
+def test_validate_rejects(condition):
+    with pytest.raises(ValueError):
+        conditions.validate(condition)
+
+
+@pytest.mark.parametrize("condition", [None, {}, {"min_level": 2, "min_gold": 10, "item": 3, "hours": [22, 4]}])
+def test_validate_accepts(condition):
+    conditions.validate(condition)
+
+
+def test_empty_condition_passes():
+    assert conditions.compiled({})(hero(), set(), NOON)
+    assert not conditions.compiled(None).checks
+
+
+def test_all_keys_must_hold():
+    check = conditions.compiled({"min_level": 2, "min_gold": 10, "item": 3})
+    assert check.needs_items
+    assert check(hero(level=2, gold=10), {3}, NOON)
+    assert not check(hero(level=1, gold=10), {3}, NOON)
+    assert not check(hero(level=2, gold=9), {3}, NOON)
+    assert not check(hero(level=2, gold=10), set(), NOON)
+
+
+def test_hours_window_wraps_midnight():
+    night = conditions.compiled({"hours": [22, 4]})
+    assert night(hero(), None, MIDNIGHT)
+    assert not night(hero(), None, NOON)
+    assert conditions.compiled({"hours": [9, 17]})(hero(), None, NOON)
+
+
+def test_invalid_condition_does_not_compile():
+    with pytest.raises(ValueError):
+        conditions.compiled({"min_level": "high"})
+
+
+def test_closed_never_passes():
+    assert not conditions.CLOSED(hero(level=100, gold=10 ** 6), set(), NOON)
+
+
+def test_blocked_skips_the_inventory_without_item_conditions():
+    gateways = [SimpleNamespace(id=1, check=conditions.compiled({"min_gold": 5})),
+                SimpleNamespace(id=2, check=conditions.compiled({})),
+                SimpleNamespace(id=3, check=conditions.CLOSED)]
+    assert conditions.blocked(gateways, hero(gold=1), NOON) == {1, 3}
@@ -0,0 +1,32 @@
+from game.fsm import CommandTrie
+
+
+def make_trie():
+    trie = CommandTrie()
+    trie.add("Buy", "buy")
+    trie.add("Buy all", "buy all")
+    trie.add("Run away", "run")
+    trie.fallback = "fallback"
+    return trie
+
+
+def test_longest_prefix_wins_and_keeps_the_rest():
+    trie = make_trie()
+    assert trie.match("Buy 2 'Plain  Sword'") == ("buy", "2 'Plain  Sword'")
+    assert trie.match("buy ALL 'Shield'") == ("buy all", "'Shield'")
+
+
+def test_matching_ignores_case():
+    assert make_trie().match("RUN AWAY") == ("run", "")
+
+
+def test_partial_command_falls_back():
+    trie = make_trie()
+    assert trie.match("Run") == ("fallback", "Run")
+    assert trie.match("Dance") == ("fallback", "Dance")
+
+
+def test_no_fallback():
+    trie = CommandTrie()
+    trie.add("Attack", "attack")
+    assert trie.match("Guard") == (None, "Guard")
@@ -0,0 +1,56 @@
+from collections import namedtuple
+from game.routes import RouteIndex
+
+Location = namedtuple("Location", ["id", "enter_price", "is_enabled"])
+Gateway = namedtuple("Gateway", ["id", "from_location_id", "to_location_id", "to_location"])
+
+
+def make_index(prices, links, disabled=()):
+    locations = {id: Location(id, price, id not in disabled) for id, price in prices.items()}
+    exits = {}
+    for n, (source, target) in enumerate(links):
+        exits.setdefault(source, []).append(Gateway(n, source, target, locations[target]))
+    return RouteIndex(locations, exits)
+
+
+# 1 -> 2 -> 4 costs 10, 1 -> 3 -> 5 -> 4 costs 2
+PRICES = {1: 0, 2: 10, 3: 1, 4: 0, 5: 1}
+LINKS = [(1, 2), (2, 4), (1, 3), (3, 5), (5, 4)]
+
+
+def gateway_ids(route):
+    return [gateway.id for gateway in route[1]]
+
+
+def test_cheapest_route():
+    route = make_index(PRICES, LINKS).route(1, 4)
+    assert route[0] == 2
+    assert gateway_ids(route) == [2, 3, 4]
+
+
+def test_ties_go_to_fewer_hops():
+    route = make_index({1: 0, 2: 0, 3: 0, 4: 0}, [(1, 2), (2, 3), (3, 4), (1, 4)]).route(1, 4)
+    assert route[0] == 0
+    assert gateway_ids(route) == [3]
+
+
+def test_blocked_gateways_are_avoided():
+    route = make_index(PRICES, LINKS).route(1, 4, blocked=frozenset({3}))
+    assert route[0] == 10
+    assert gateway_ids(route) == [0, 1]
+
+
+def test_disabled_locations_are_avoided():
+    assert make_index(PRICES, LINKS, disabled={2}).route(1, 4, blocked=frozenset({3})) is None
+
+
+def test_route_to_self_is_empty():
+    assert make_index(PRICES, LINKS).route(1, 1) == (0, [])
+
+
+def test_tree_cache_is_bounded():
+    index = make_index(PRICES, LINKS)
+    index.size = 2
+    for blocked in ({0}, {1}, {2}):
+        index.tree(1, frozenset(blocked))
+    assert len(index._trees) == 2
@@ -0,0 +1,26 @@
+import random
+from collections import Counter
+import pytest
+from game.sampling import AliasTable
+
+
+def test_alias_table_follows_weights():
+    table = AliasTable(["a", "b", "c"], [1, 2, 7])
+    rng = random.Random(1)
+    draws = Counter(table.sample(rng) for _ in range(100000))
+    assert draws["a"] / 100000 == pytest.approx(0.1, abs=0.01)
+    assert draws["b"] / 100000 == pytest.approx(0.2, abs=0.01)
+    assert draws["c"] / 100000 == pytest.approx(0.7, abs=0.01)
+
+
+def test_alias_table_never_draws_zero_weights():
+    table = AliasTable(["never", "always"], [0, 3])
+    rng = random.Random(2)
+    assert {table.sample(rng) for _ in range(1000)} == {"always"}
+
+
+def test_alias_table_rejects_empty_and_zero_weights():
+    with pytest.raises(ValueError):
+        AliasTable([], [])
+    with pytest.raises(ValueError):
+        AliasTable(["a"], [0])
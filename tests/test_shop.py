@@ -0,0 +1,18 @@
+import pytest
+from game.shop import parse_order
+
+
+@pytest.mark.parametrize("text, allow_all, order", [
+    ("'Plain Sword'", False, (1, "Plain Sword")),
+    ("3 'Shield'", False, (3, "Shield")),
+    ("all 'Shield'", True, (None, "Shield")),
+    ("ALL 'Shield'", True, (None, "Shield")),
+    ("all 'Shield'", False, None),
+    ("0 'Shield'", False, None),
+    ("-1 'Shield'", False, None),
+    ("2 Shield", False, None),
+    ("'", False, None),
+    ("", False, None),
+])
+def test_parse_order(text, allow_all, order):
+    assert parse_order(text, allow_all) == order